@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""
+arweave.py
+
+Async client for an Arweave gateway. GraphQL queries and TX data downloads share a
+single aiohttp session (and so a single connection pool), which is opened inside the
+running event loop and reused for the lifetime of the crawler.
+"""
+
+import os
+import time
+import codecs
+from dotenv import load_dotenv
+import aiohttp
+import metrics
+
+
+TX_TAGS_QUERY = """
+query ($id: ID!) {
+    transaction(id: $id) {
+        id
+        tags {
+            name
+            value
+        }
+    }
+}
+"""
+
+TXS_TAGS_QUERY = """
+query ($ids: [ID!], $first: Int) {
+    transactions(ids: $ids, first: $first) {
+        edges {
+            node {
+                id
+                tags {
+                    name
+                    value
+                }
+            }
+        }
+    }
+}
+"""
+
+HEIGHT_QUERY = """
+query {
+    blocks(first: 1) {
+        edges {
+            node {
+                height
+            }
+        }
+    }
+}
+"""
+
+BLOCK_TXS_QUERY = """
+query ($min: Int, $max: Int, $first: Int, $after: String) {
+    transactions(block: {min: $min, max: $max}, first: $first, after: $after, sort: HEIGHT_ASC) {
+        edges {
+            cursor
+            node {
+                id
+                block {
+                    height
+                }
+                tags {
+                    name
+                    value
+                }
+            }
+        }
+        pageInfo {
+            hasNextPage
+        }
+    }
+}
+"""
+
+# most gateways cap transactions(first: ...) at 100
+MAX_PAGE_SIZE = 100
+
+# content types whose bodies are worth downloading
+TEXT_CONTENT_TYPES = ("text/", "application/json", "application/xhtml+xml", "application/xml")
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+log = metrics.get_logger("Arweave")
+GRAPHQL_SECONDS = metrics.histogram("arweave_graphql_seconds", "Gateway GraphQL query latency")
+GRAPHQL_ERRORS = metrics.counter("arweave_graphql_errors_total", "Failed gateway GraphQL queries")
+FETCHES = metrics.counter("arweave_fetches_total", "Gateway body fetches by result")
+FETCH_BYTES = metrics.counter("arweave_fetch_bytes_total", "Body bytes read from the gateway")
+FETCH_SECONDS = metrics.histogram("arweave_fetch_seconds", "Gateway body fetch latency")
+
+
+def is_text_content_type(content_type):
+    """
+    Check whether a Content-Type header/tag is a text type
+    """
+    return content_type.lower().startswith(TEXT_CONTENT_TYPES)
+
+
+def tx_size(response):
+    """
+    Total size of a TX body from a (possibly ranged) response, or None if unknown
+    """
+    content_range = response.headers.get("Content-Range")
+    if content_range is not None and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    if response.status == 200 and response.content_length is not None:
+        return response.content_length
+    return None
+
+
+class ArweaveError(Exception):
+    """
+    Raised when the gateway returns GraphQL errors, or an error status for TX data
+    """
+
+
+class ArweaveClient:
+    """
+    Arweave gateway + GraphQL client
+    """
+
+    def __init__(self, connections=None):
+        """
+        Constructor
+        """
+        load_dotenv()
+        self.gql_url = os.getenv("ARWEAVE_GQL_HOST") + "/graphql"
+        self.gateway_url = "https://" + os.getenv("GATEWAY_HOST")
+        self.connections = int(connections or os.getenv("ARWEAVE_CONNECTIONS", "64"))
+        self.session = None
+
+    async def open(self):
+        """
+        Open the shared HTTP session
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={"User-Agent": "Python-arweave"},
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(total=60),
+            )
+        return self
+
+    async def close(self):
+        """
+        Close the shared HTTP session
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def query(self, query, variables=None):
+        """
+        Execute a GraphQL query against the gateway
+        """
+        payload = {"query": query, "variables": variables or {}}
+        try:
+            with GRAPHQL_SECONDS.time():
+                async with self.session.post(self.gql_url, json=payload) as response:
+                    response.raise_for_status()
+                    result = await response.json()
+            if result.get("errors"):
+                raise ArweaveError(result["errors"])
+        except Exception:
+            GRAPHQL_ERRORS.inc()
+            raise
+        return result["data"]
+
+    async def get_height(self):
+        """
+        Get the latest block height
+        """
+        result = await self.query(HEIGHT_QUERY)
+        return result["blocks"]["edges"][0]["node"]["height"]
+
+    async def get_block_txs(self, min_block, max_block, first=MAX_PAGE_SIZE, after=None):
+        """
+        Get a page of the TXs (with tags) in blocks min_block..max_block
+        """
+        result = await self.query(
+            BLOCK_TXS_QUERY,
+            {"min": min_block, "max": max_block, "first": first, "after": after},
+        )
+        return result["transactions"]
+
+    async def get_tx_tags(self, txid):
+        """
+        Get the tags for a TX
+        """
+        result = await self.query(TX_TAGS_QUERY, {"id": txid})
+        return result["transaction"]["tags"]
+
+    async def get_txs_tags(self, txids):
+        """
+        Get the tags for many TXs, 100 per query
+
+        Returns a dict of txid -> tags. TXs the gateway doesn't know yet are left out.
+        """
+        tags = {}
+        for i in range(0, len(txids), MAX_PAGE_SIZE):
+            ids = txids[i : i + MAX_PAGE_SIZE]
+            result = await self.query(TXS_TAGS_QUERY, {"ids": ids, "first": len(ids)})
+            for edge in result["transactions"]["edges"]:
+                tags[edge["node"]["id"]] = edge["node"]["tags"]
+        return tags
+
+    async def get_tx_data(self, txid, max_bytes=None, skip_bytes=None, digest=None):
+        """
+        Get the data for a TX
+
+        Streams at most max_bytes of the body, decoding it incrementally with the
+        charset from the response. The request asks for just that byte range, so
+        gateways that honour Range don't send the rest at all. Returns None if the
+        body isn't text or the TX is bigger than skip_bytes. Raises ArweaveError on an
+        error status: a TX seconds after confirmation may not be on the gateway yet.
+
+        `digest`, a hashlib object, is updated with the raw bytes as they are read.
+        """
+        max_bytes = int(max_bytes or os.getenv("CRAWLER_MAX_BODY_BYTES", "50000"))
+        skip_bytes = int(skip_bytes or os.getenv("CRAWLER_SKIP_BODY_BYTES", str(10 * 1024 * 1024)))
+        url = self.gateway_url + "/" + txid
+        headers = {"Range": "bytes=0-%d" % (max_bytes - 1)}
+        start = time.perf_counter()
+        async with self.session.get(url, headers=headers) as response:
+            # check the status code
+            if response.status not in (200, 206):
+                FETCHES.inc(result="error")
+                raise ArweaveError("Error getting data for TX %s: %s" % (txid, response.status))
+            # check the headers before reading any of the body
+            content_type = response.headers.get("Content-Type", "")
+            if not is_text_content_type(content_type):
+                if metrics.sampled(log):
+                    log.debug("Skipping non-text TX: %s %s", txid, content_type)
+                FETCHES.inc(result="skipped")
+                return None
+            size = tx_size(response)
+            if skip_bytes and size is not None and size > skip_bytes:
+                if metrics.sampled(log):
+                    log.debug("Skipping oversized TX: %s %s", txid, size)
+                FETCHES.inc(result="skipped")
+                return None
+            try:
+                decoder = codecs.getincrementaldecoder(response.charset or "utf-8")("replace")
+            except LookupError:
+                decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            parts = []
+            read = 0
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                # gateways that ignore Range send everything, stop at the cap
+                chunk = chunk[: max_bytes - read]
+                read += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                parts.append(decoder.decode(chunk))
+                if read >= max_bytes:
+                    break
+            parts.append(decoder.decode(b"", final=True))
+            FETCHES.inc(result="ok")
+            FETCH_BYTES.inc(read)
+            FETCH_SECONDS.observe(time.perf_counter() - start)
+            return "".join(parts)
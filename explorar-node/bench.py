@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+bench.py
+
+Micro-benchmarks for the explorar-node hot paths.
+
+Usage:
+    python bench.py <benchmark> [args...]
+
+Benchmarks:
+    classify [n]    classify n synthetic tag lists (default 1,000,000)
+    extract <dir>   extract text from the saved HTML pages in dir
+    claim [n]       frontier claim latency per scheduling policy with n queued TXs
+                    (default 10,000,000), in a bench_artx collection of MONGODB_DATABASE
+    load <url> [queries] [levels] [requests]
+                    p50/p99 latency of GET <url>/search at each concurrency level
+                    (default 1,8,32,128), with queries from a file, one per line
+    querylog <file> [rounds]
+                    ES latency of each logged query as a Lucene query string (the old
+                    q= search) and through the query builder
+    startup [runs]  time to import and construct the API app and a crawler, in fresh
+                    interpreters (default 10 runs)
+"""
+
+import os
+import sys
+import time
+import random
+import subprocess
+
+
+def synthetic_tag_lists(n, distinct=10000, seed=110):
+    """
+    Build n synthetic tag lists, cycling over `distinct` generated ones
+    """
+    rng = random.Random(seed)
+    content_types = ["text/html", "text/html; charset=utf-8", "image/png", "image/jpeg",
+                     "video/mp4", "application/json", "application/octet-stream", "text/plain"]
+    apps = ["ArDrive-Web", "ArConnect", "Permapages", "SmartWeave", "Bundlr"]
+    pool = []
+    for i in range(distinct):
+        tags = [{"name": "Content-Type", "value": rng.choice(content_types)}]
+        if rng.random() < 0.6:
+            tags.append({"name": "App-Name", "value": rng.choice(apps)})
+            tags.append({"name": "App-Version", "value": "0.%d.0" % rng.randrange(10)})
+        if rng.random() < 0.3:
+            tags.append({"name": "Title", "value": "Title %d" % i})
+            tags.append({"name": "Type", "value": rng.choice(["image", "page", "music"])})
+            tags.append({"name": "Description", "value": "Description of %d" % i})
+            for t in range(rng.randrange(4)):
+                tags.append({"name": "Topic:t%d" % t, "value": "t%d" % t})
+        if rng.random() < 0.1:
+            tags.append({"name": "License", "value": "udl://license"})
+        if rng.random() < 0.1:
+            tags.append({"name": "Bundle-Format", "value": "binary"})
+            tags.append({"name": "Bundle-Version", "value": "2.0.0"})
+        for t in range(rng.randrange(5)):
+            tags.append({"name": "X-Custom-%d" % t, "value": "v%d" % t})
+        rng.shuffle(tags)
+        pool.append(tags)
+    return [pool[i % distinct] for i in range(n)]
+
+
+def bench_classify(n="1000000"):
+    """
+    Throughput of the rule table classifier
+    """
+    from classifier import classify_tags, classify_batch
+    n = int(n)
+    corpus = synthetic_tag_lists(n)
+    tags = sum(len(t) for t in corpus)
+    print("classify: %d tag lists, %d tags" % (n, tags))
+    start = time.perf_counter()
+    for t in corpus:
+        classify_tags(t)
+    elapsed = time.perf_counter() - start
+    print("  classify_tags:  %.2fs  %.0f lists/s  %.0f tags/s" % (elapsed, n / elapsed, tags / elapsed))
+    start = time.perf_counter()
+    for i in range(0, n, 1000):
+        classify_batch(corpus[i : i + 1000])
+    elapsed = time.perf_counter() - start
+    print("  classify_batch: %.2fs  %.0f lists/s  %.0f tags/s" % (elapsed, n / elapsed, tags / elapsed))
+
+
+def bench_extract(directory, max_bytes="50000", workers=None):
+    """
+    Docs/sec of HTML text extraction and size of the indexed content before/after
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from extractor import extract
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as f:
+            # same cap as the crawler applies to downloads
+            pages.append(f.read(int(max_bytes)).decode("utf-8", "replace"))
+    raw = sum(len(p.encode()) for p in pages)
+    print("extract: %d pages, %d bytes" % (len(pages), raw))
+    start = time.perf_counter()
+    results = [extract(p) for p in pages]
+    elapsed = time.perf_counter() - start
+    print("  serial:  %.2fs  %.0f docs/s" % (elapsed, len(pages) / elapsed))
+    with ProcessPoolExecutor(max_workers=int(workers) if workers else None) as pool:
+        start = time.perf_counter()
+        list(pool.map(extract, pages, chunksize=16))
+        elapsed = time.perf_counter() - start
+    print("  pool:    %.2fs  %.0f docs/s" % (elapsed, len(pages) / elapsed))
+    text = sum(len(r["content"].encode()) for r in results)
+    print("  content: %d -> %d bytes (%.1f%% smaller)" % (raw, text, 100 - 100.0 * text / max(raw, 1)))
+
+
+def percentiles(samples):
+    """
+    p50, p99 and max of latency samples, in milliseconds
+    """
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return "p50 %.2fms  p99 %.2fms  max %.2fms" % (pick(0.5), pick(0.99), samples[-1] * 1000)
+
+
+def bench_claim(n="10000000", rounds="200"):
+    """
+    Claim latency of each scheduling policy against n queued TXs
+    """
+    import asyncio
+    from frontier import AsyncFrontier, SCHEDULING_POLICIES
+    n = int(n)
+    rounds = int(rounds)
+
+    async def run():
+        frontier = AsyncFrontier(collection_name="bench_artx")
+        queued = await frontier.collection.estimated_document_count()
+        if queued < n:
+            # synthetic queue: uncrawled TXs over 100k blocks with mixed priorities
+            print("claim: inserting %d TXs" % (n - queued))
+            rng = random.Random(13)
+            for start in range(queued, n, 10000):
+                await frontier.collection.insert_many([
+                    {
+                        "txid": "bench-%d" % i,
+                        "block_no": rng.randrange(100000),
+                        "priority": rng.choice([0, 0, 0, 0, 1, 2, 3]),
+                        "crawled_at": None,
+                    }
+                    for i in range(start, min(start + 10000, n))
+                ], ordered=False)
+        await frontier.init_indexes()
+        print("claim: %d queued TXs" % await frontier.collection.estimated_document_count())
+        for policy, sort in SCHEDULING_POLICIES.items():
+            frontier.sort = sort
+            for k in (1, 100):
+                samples = []
+                for _ in range(rounds):
+                    start = time.perf_counter()
+                    txs = await frontier.claim_txs(k)
+                    samples.append(time.perf_counter() - start)
+                    await frontier.release_leases(txs)
+                print("  %-8s k=%-3d  %s" % (policy, k, percentiles(samples)))
+        frontier.close()
+
+    asyncio.run(run())
+
+
+def bench_load(url="http://127.0.0.1:8000", queries=None, levels="1,8,32,128", requests="2000"):
+    """
+    Load test of the /search endpoint of a running API server
+    """
+    import asyncio
+    import aiohttp
+    if queries:
+        with open(queries) as f:
+            terms = [line.strip() for line in f if line.strip()]
+    else:
+        terms = ["redstone", "arweave", "nft", "permaweb", "music", "art", "smartweave"]
+    requests = int(requests)
+
+    async def run(concurrency):
+        samples = []
+        errors = 0
+        queue = asyncio.Queue()
+        for i in range(requests):
+            queue.put_nowait(terms[i % len(terms)])
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+            async def worker():
+                nonlocal errors
+                while not queue.empty():
+                    term = queue.get_nowait()
+                    start = time.perf_counter()
+                    async with session.get(url + "/search", params={"query": term}) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                    samples.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+        print("  c=%-4d %6.0f req/s  %s  errors %d"
+              % (concurrency, requests / elapsed, percentiles(samples), errors))
+
+    print("load: %s/search, %d requests per level" % (url, requests))
+    for level in levels.split(","):
+        asyncio.run(run(int(level)))
+
+
+def bench_querylog(path, rounds="3"):
+    """
+    Latency of a query log with q= query strings vs. the query builder
+    """
+    import asyncio
+    from search import SearchClient, build_query, RESULT_FIELDS
+    with open(path) as f:
+        queries = [line.rstrip("\n") for line in f if line.strip()]
+
+    async def run():
+        search_client = SearchClient()
+        index = "search-artx"
+        forms = {
+            "query_string": lambda q: {"query": {"query_string": {"query": q}}},
+            "builder": lambda q: {"query": build_query(q), "_source": {"includes": RESULT_FIELDS}},
+        }
+        print("querylog: %d queries x %d rounds" % (len(queries), int(rounds)))
+        try:
+            for name, form in forms.items():
+                samples = []
+                errors = 0
+                for _ in range(int(rounds)):
+                    for q in queries:
+                        start = time.perf_counter()
+                        try:
+                            # request_cache off so repeated rounds measure the query itself
+                            await search_client.client.search(index=index, body=form(q),
+                                                              request_cache=False)
+                        except Exception:
+                            errors += 1
+                        samples.append(time.perf_counter() - start)
+                print("  %-12s %s  errors %d" % (name, percentiles(samples), errors))
+        finally:
+            await search_client.close()
+
+    asyncio.run(run())
+
+
+# startup of each process: imports plus construction of its clients
+STARTUP = {
+    "api": "import main",
+    "crawler": "import crawler; crawler.Crawler()",
+}
+
+
+def bench_startup(runs="10"):
+    """
+    Startup time of the API and crawler processes, no backend round trips expected
+    """
+    print("startup: %d runs each" % int(runs))
+    for name, code in STARTUP.items():
+        samples = []
+        for _ in range(int(runs)):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+            samples.append(time.perf_counter() - start)
+        print("  %-8s %s" % (name, percentiles(samples)))
+
+
+BENCHMARKS = {
+    "classify": bench_classify,
+    "extract": bench_extract,
+    "claim": bench_claim,
+    "load": bench_load,
+    "querylog": bench_querylog,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
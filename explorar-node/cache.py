@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+cache.py
+
+Search result cache.
+
+ResultCache keeps results in process in an LRU with a TTL and a cap on the
+(approximate, JSON encoded) size of the cached values. When REDIS_URL is set,
+results are also written to Redis, so API workers share each other's hits.
+
+Cached results are versioned by the index version counter in Redis: the indexer
+bumps it after bulk writes (bump_index_version), which changes every cache key.
+Bumps are coalesced to one per INDEX_VERSION_BUMP_SECONDS, so a steady crawl doesn't
+empty the caches on every flush; new documents show up within that interval. Without
+Redis, entries expire after the TTL.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from dotenv import load_dotenv
+import redis.asyncio
+from redis.exceptions import RedisError
+
+INDEX_VERSION_KEY = "explorar:index_version"
+
+async_redis = None
+# monotonic time of the last version bump, and the task of a pending, coalesced bump
+last_bump = 0.0
+pending_bump = None
+
+
+def get_async_redis():
+    """
+    Shared asyncio Redis client, or None if REDIS_URL isn't set
+    """
+    global async_redis
+    load_dotenv()
+    if async_redis is None and os.getenv("REDIS_URL"):
+        async_redis = redis.asyncio.from_url(os.getenv("REDIS_URL"))
+    return async_redis
+
+
+async def bump_index_version():
+    """
+    Invalidate all cached search results, called by the indexer after writes
+
+    At most one bump per INDEX_VERSION_BUMP_SECONDS goes to Redis, a bump within
+    that interval of the last one is delayed until its end (and merged with others).
+    """
+    global pending_bump
+    client = get_async_redis()
+    if client is None:
+        return
+    wait = last_bump + float(os.getenv("INDEX_VERSION_BUMP_SECONDS", "10")) - time.monotonic()
+    if wait <= 0:
+        await incr_index_version(client)
+    elif pending_bump is None:
+        pending_bump = asyncio.create_task(delayed_bump(client, wait))
+
+
+async def incr_index_version(client):
+    global last_bump
+    last_bump = time.monotonic()
+    try:
+        await client.incr(INDEX_VERSION_KEY)
+    except RedisError as e:
+        # cached results expire after their TTL, writes go on
+        print("Cache: Error bumping index version:", e)
+
+
+async def delayed_bump(client, wait):
+    global pending_bump
+    await asyncio.sleep(wait)
+    pending_bump = None
+    await incr_index_version(client)
+
+
+async def flush_index_version():
+    """
+    Apply a pending coalesced bump now, before the process exits
+    """
+    global pending_bump
+    if pending_bump is not None:
+        pending_bump.cancel()
+        pending_bump = None
+        await incr_index_version(get_async_redis())
+
+
+def normalize_query(query):
+    """
+    Normalize a query string for use in a cache key
+    """
+    # queries go through an analyzed multi_match, so case doesn't matter
+    return " ".join(query.lower().split())
+
+
+def cache_key(*parts):
+    """
+    Build a cache key from JSON serializable parts
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU + TTL result cache with a memory cap and optional Redis backing
+
+    With REDIS_URL set, entries are keyed by the index version, so writes invalidate
+    them (within INDEX_VERSION_BUMP_SECONDS). Without it the cache is TTL-only: nothing
+    invalidates entries, a cached result can be up to `ttl` seconds behind the index.
+    """
+
+    def __init__(self, max_bytes=None, ttl=None, version_check_seconds=None, share=True):
+        """
+        Constructor
+
+        With share=False values are only kept in process, but still invalidated by
+        the index version in Redis.
+        """
+        load_dotenv()
+        self.max_bytes = int(max_bytes or os.getenv("SEARCH_CACHE_BYTES", str(64 * 1024 * 1024)))
+        self.ttl = float(ttl or os.getenv("SEARCH_CACHE_TTL", "30"))
+        self.version_check_seconds = float(
+            version_check_seconds or os.getenv("SEARCH_CACHE_VERSION_CHECK_SECONDS", "1")
+        )
+        # key -> (expires, size, value)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.shared = get_async_redis()
+        self.share = share
+        self.version = "0"
+        self.version_checked = 0
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0}
+
+    async def current_version(self):
+        """
+        Index version, re-read from Redis at most every version_check_seconds
+        """
+        if self.shared is None:
+            return self.version
+        now = time.monotonic()
+        if now - self.version_checked >= self.version_check_seconds:
+            try:
+                self.version = (await self.shared.get(INDEX_VERSION_KEY) or b"0").decode()
+            except RedisError as e:
+                print("Cache: Error reading index version:", e)
+            self.version_checked = now
+        return self.version
+
+    async def versioned(self, key):
+        return "explorar:search:%s:%s" % (await self.current_version(), key)
+
+    async def get(self, key):
+        """
+        Get a cached value, or None
+        """
+        key = await self.versioned(key)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[2]
+            self.remove(key)
+        if self.shared is not None and self.share:
+            try:
+                encoded = await self.shared.get(key)
+            except RedisError as e:
+                print("Cache: Error reading shared cache:", e)
+                encoded = None
+            if encoded is not None:
+                self.stats["shared_hits"] += 1
+                value = json.loads(encoded)
+                self.store(key, value, len(encoded))
+                return value
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key, value):
+        """
+        Cache a JSON serializable value
+        """
+        key = await self.versioned(key)
+        encoded = json.dumps(value, default=str)
+        self.store(key, value, len(encoded))
+        if self.shared is not None and self.share:
+            try:
+                await self.shared.set(key, encoded, ex=max(1, int(self.ttl)))
+            except RedisError as e:
+                print("Cache: Error writing shared cache:", e)
+
+    def store(self, key, value, size=None):
+        """
+        Store a value locally, evicting least recently used entries over max_bytes
+        """
+        if size is None:
+            size = len(json.dumps(value, default=str))
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            (_, (_, evicted, _)) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.stats["evictions"] += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
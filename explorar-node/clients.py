@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+clients.py
+
+Registry of the shared network clients of a process: one pooled AsyncElasticsearch
+client, one motor (MongoDB) client and the Redis client of cache.py.
+
+Clients are built on first use and constructing them does no network I/O, so modules
+can be imported, and the API can start, while a backend is down. Connectivity is
+checked with check(), which pings all the clients that were built, concurrently,
+and reports instead of raising. close() closes them all at shutdown.
+"""
+
+import os
+import asyncio
+from dotenv import load_dotenv
+from elasticsearch import AsyncElasticsearch
+from motor.motor_asyncio import AsyncIOMotorClient
+from cache import get_async_redis
+
+elastic = None
+mongo = None
+
+
+def mongo_uri():
+    """
+    Build the MongoDB connection string from the environment
+    """
+    # MONGODB_HOST, MONGODB_PORT, MONGODB_USER and MONGODB_PASSWORD
+    return (
+        "mongodb://"
+        + os.getenv("MONGODB_USER")
+        + ":"
+        + os.getenv("MONGODB_PASSWORD")
+        + "@"
+        + os.getenv("MONGODB_HOST")
+        + ":"
+        + os.getenv("MONGODB_PORT")
+    )
+
+
+def get_elastic():
+    """
+    Shared AsyncElasticsearch client
+    """
+    global elastic
+    if elastic is None:
+        load_dotenv()
+        elastic = AsyncElasticsearch(
+            "http://" + os.getenv("ELASTICSEARCH_HOST") + ":" + os.getenv("ELASTICSEARCH_PORT"),
+            api_key=os.getenv("ELASTICSEARCH_API_KEY"),
+            connections_per_node=int(os.getenv("ES_CONNECTIONS", "32")),
+        )
+    return elastic
+
+
+def get_mongo():
+    """
+    Shared motor client, it connects in the background on first use
+    """
+    global mongo
+    if mongo is None:
+        load_dotenv()
+        mongo = AsyncIOMotorClient(mongo_uri())
+    return mongo
+
+
+async def ping_elastic(client):
+    # the API key should have cluster monitor rights
+    info = await client.info()
+    return "Elasticsearch " + info["version"]["number"]
+
+
+async def ping_mongo(client):
+    info = await client.server_info()
+    return "MongoDB " + info["version"]
+
+
+async def ping_redis(client):
+    await client.ping()
+    return "Redis"
+
+
+async def check():
+    """
+    Ping the clients built so far, concurrently
+
+    Returns {name: version string or exception}, and prints the outcome
+    """
+    pings = {}
+    if elastic is not None:
+        pings["elastic"] = ping_elastic(elastic)
+    if mongo is not None:
+        pings["mongo"] = ping_mongo(mongo)
+    if get_async_redis() is not None:
+        pings["redis"] = ping_redis(get_async_redis())
+    results = await asyncio.gather(*pings.values(), return_exceptions=True)
+    status = dict(zip(pings, results))
+    for name, result in status.items():
+        if isinstance(result, Exception):
+            print("Clients: %s is unavailable: %r" % (name, result))
+        else:
+            print("Clients: Connected to", result)
+    return status
+
+
+async def close_elastic():
+    global elastic
+    if elastic is not None:
+        await elastic.close()
+        elastic = None
+
+
+def close_mongo():
+    global mongo
+    if mongo is not None:
+        mongo.close()
+        mongo = None
+
+
+async def close():
+    """
+    Close all clients, they are rebuilt if used again
+    """
+    import cache
+    await close_elastic()
+    close_mongo()
+    if cache.async_redis is not None:
+        await cache.async_redis.close()
+        cache.async_redis = None
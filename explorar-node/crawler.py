@@ -6,128 +6,407 @@ import time
 import json
 from dotenv import load_dotenv
 import asyncio
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
-from frontier import Frontier
-from indexer import Indexer
-import requests
+import datetime
+import signal
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from arweave import ArweaveClient, MAX_PAGE_SIZE
+from frontier import AsyncFrontier
+from indexer import AsyncIndexer
+from classifier import classify
+from extractor import extract
+import metrics
 # scrapy
 
 
 
+log = metrics.get_logger("Crawler")
+
+
+class Stage:
+    """
+    A crawl pipeline stage: `workers` tasks taking jobs from a bounded input queue,
+    handing each to `handler` and putting the result on the next stage's queue
+
+    A full queue blocks the stage feeding it, so a slow stage throttles the ones
+    before it instead of piling up jobs. The handler returns None to drop a job.
+    """
+
+    def __init__(self, name, handler, workers, queue_size):
+        """
+        Constructor
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.next = None
+        self.processed = 0
+        self.errors = 0
+        # seconds spent in handler, summed over workers
+        self.busy_seconds = 0.0
+        self.reported = (time.monotonic(), 0, 0.0)
+
+    async def work(self, on_error):
+        """
+        Worker task: run jobs through the handler until cancelled
+        """
+        while True:
+            job = await self.queue.get()
+            start = time.monotonic()
+            try:
+                result = await self.handler(job)
+            except Exception as e:
+                self.errors += 1
+                on_error(self.name, job, e)
+                result = None
+            finally:
+                self.busy_seconds += time.monotonic() - start
+                self.processed += 1
+                self.queue.task_done()
+            if result is not None and self.next is not None:
+                await self.next.queue.put(result)
+
+    def stats(self):
+        """
+        Queue depth, totals, and throughput and utilization since the last call
+        """
+        now = time.monotonic()
+        (then, processed, busy) = self.reported
+        elapsed = max(now - then, 1e-9)
+        self.reported = (now, self.processed, self.busy_seconds)
+        return {
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "workers": self.workers,
+            "processed": self.processed,
+            "errors": self.errors,
+            "per_second": round((self.processed - processed) / elapsed, 2),
+            # near 1.0: every worker always busy, this stage is the bottleneck
+            "utilization": round((self.busy_seconds - busy) / elapsed / self.workers, 3),
+        }
+
+
 class Crawler:
     """
     Crawler class
+
+    Crawls TXs on a single event loop as a pipeline of stages with bounded queues
+    between them:
+    - feed: leases TXs from the frontier with their tags (one task)
+    - fetch: gateway body downloads for HTML TXs (CRAWLER_FETCH_WORKERS tasks)
+    - parse: HTML text extraction in a process pool (CRAWLER_PARSE_WORKERS processes)
+    - classify: tag classification, building the document
+    - index: writes to the bulk indexer, the frontier is updated on acknowledgement
+    Each stage has its own worker count, so the network stages overlap many TXs while
+    parsing is bounded by CPUs, and report() shows the depth and throughput of each.
+    Any number of crawler processes can run against the same frontier.
     """
 
-    def __init__(self):
+    def __init__(self, concurrency=None):
         """
         Constructor
         """
         load_dotenv()
-        self.frontier = Frontier()
-        # graphql client
-        self.transport = AIOHTTPTransport(
-            url=os.getenv("ARWEAVE_GQL_HOST") + "/graphql",
-            headers={"User-Agent": "Python-arweave"},
-        )
-        self.gql = Client(transport=self.transport, fetch_schema_from_transport=True)
-        # indexer, frontier
-        self.indexer = Indexer()
-        self.frontier = Frontier()
-    
-    def get_tx_data(self, tx):
-        """
-        Get the data for a TX
-        """
-        # get the data via HTTP
-        query = "https://" + os.getenv("GATEWAY_HOST") + "/" + tx["txid"]
-        print("Crawler: Getting data for TX:", query)
-        response = requests.get(query)
-        # check the status code
-        if response.status_code != 200:
-            print("Crawler: Error getting data for TX:", tx["txid"])
-            return None
-        # return the data
-        return response.text
-
-    def crawl(self, block_no=None):
-        """
-        The main crawl function
-        
-        A crawler should:
-        - Get a url/tx from frontier
-        - get metadata for the url/tx
-        - get data for the url/tx if it is a content tx
-        - index the data
-        - update the frontier
-        """
-        # get the next TX from the frontier
-        if block_no is None:
-            tx = self.frontier.get_next_tx()
-        else:
-            tx = self.frontier.get_next_tx(int(block_no))
-        if tx is None:
-            print("Crawler: No TXs to crawl")
-            return
-        # get the metadata for the TX
-        query = """
-        query {
-            transaction(id: "%s") {
-                id
-                tags {
-                    name
-                    value
-                }
-            }
-        }
-        """ % (
-            tx["txid"]
-        )
-        result = self.gql.execute(gql(query))
-        # get the tags
-        tags = result["transaction"]["tags"]
-        # look for the Content-Type tag
+        self.concurrency = int(concurrency or os.getenv("CRAWLER_CONCURRENCY", "16"))
+        # async clients: gateway + graphql share one aiohttp session
+        self.arweave = ArweaveClient()
+        self.frontier = AsyncFrontier()
+        self.indexer = AsyncIndexer()
+        # leased TXs that are queued, being crawled or waiting to be indexed, by txid
+        self.in_flight = {}
+        # tasks marking TXs crawled once their documents are indexed
+        self.marking = set()
+        # where tag lookups were served from, and the GraphQL queries they took
+        self.stats = {"tags_from_frontier": 0, "tags_from_network": 0, "tag_queries": 0,
+                      "duplicates": 0}
+        self.report_seconds = int(os.getenv("CRAWLER_REPORT_SECONDS", "60"))
+        # bodies are truncated to max_body_bytes, TXs over skip_body_bytes are not fetched
+        self.max_body_bytes = int(os.getenv("CRAWLER_MAX_BODY_BYTES", "50000"))
+        self.skip_body_bytes = int(os.getenv("CRAWLER_SKIP_BODY_BYTES", str(10 * 1024 * 1024)))
+        # indexed text per page, the rest of a long page adds postings but rarely relevance
+        self.max_text = int(os.getenv("CRAWLER_MAX_TEXT_CHARS", "20000"))
+        # HTML parsing is CPU bound, keep it off the event loop
+        parse_workers = int(os.getenv("CRAWLER_PARSE_WORKERS", str(os.cpu_count() or 1)))
+        self.parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+        queue_size = int(os.getenv("CRAWLER_QUEUE_SIZE", str(self.concurrency * 2)))
+        self.stages = [
+            Stage("fetch", self.fetch,
+                  int(os.getenv("CRAWLER_FETCH_WORKERS", str(self.concurrency))), queue_size),
+            # twice the processes, so the pool has the next page ready when one finishes
+            Stage("parse", self.parse, parse_workers * 2, queue_size),
+            # classify takes microseconds a TX, cheaper than shipping it to the pool
+            Stage("classify", self.classify, 1, queue_size),
+            Stage("index", self.index,
+                  int(os.getenv("CRAWLER_INDEX_WORKERS", "4")), queue_size),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        # scrape endpoint for this process' metrics, off unless a port is set
+        self.metrics_port = int(os.getenv("CRAWLER_METRICS_PORT", "0"))
+        metrics.add_collector(self.gauges)
+
+    async def fetch(self, job):
+        """
+        Fetch stage: get the metadata of the TX, and its body if it's an HTML page
+
+        Bodies over skip_body_bytes are skipped, the rest are streamed up to max_body_bytes
+        and hashed on the way. A body already crawled under another TX isn't parsed
+        again: the TX is indexed with its tags and a reference to the canonical TX.
+        A gateway error fails the stage, so the TX keeps its lease and is retried.
+        """
+        tx = job["tx"]
+        # get the metadata for the TX, normally attached by fetch_tags
+        tags = tx.get("tags")
+        if tags is None:
+            tags = await self.arweave.get_tx_tags(tx["txid"])
+            self.stats["tags_from_network"] += 1
+            self.stats["tag_queries"] += 1
+        job["tags"] = tags
+        # look for the Content-Type and Content-Length tags
         content_type = None
+        content_length = None
         for tag in tags:
             if tag["name"] == "Content-Type":
                 content_type = tag["value"]
-                break
-        # if the content type is text/html, get the data and index it using scrapy
-        content =  None
-        if content_type == "text/html":
-            # get the data via HTTP
-            data = self.get_tx_data(tx)
-            # truncate the data upto 50KB
-            content = data[:50000]
-        # index the document
+            elif tag["name"] == "Content-Length" and tag["value"].isdigit():
+                content_length = int(tag["value"])
+        # if the content type is text/html, get the data to index its text
+        job["html"] = None
+        if content_type is not None and content_type.startswith("text/html"):
+            if content_length is not None and content_length > self.skip_body_bytes:
+                if metrics.sampled(log):
+                    log.debug("Skipping oversized TX: %s %s", tx["txid"], content_length)
+            else:
+                # stream the first max_body_bytes of the data via HTTP
+                digest = hashlib.sha256()
+                job["html"] = await self.arweave.get_tx_data(
+                    tx["txid"], self.max_body_bytes, self.skip_body_bytes, digest
+                )
+                if job["html"] is not None:
+                    # the indexed fields only depend on the bytes fetched, so equal
+                    # hashes mean equal documents even for truncated bodies
+                    job["content_hash"] = digest.hexdigest()
+                    canonical = await self.frontier.claim_content_hash(
+                        job["content_hash"], tx["txid"]
+                    )
+                    if canonical != tx["txid"]:
+                        job["canonical"] = canonical
+                        job["html"] = None
+                        self.stats["duplicates"] += 1
+        return job
+
+    async def parse(self, job):
+        """
+        Parse stage: extract the text, title, description and links of HTML pages
+        """
+        job["page"] = {}
+        html = job.pop("html")
+        if html is not None:
+            job["page"] = await asyncio.get_running_loop().run_in_executor(
+                self.parse_pool, extract, html, self.max_text
+            )
+        return job
+
+    async def classify(self, job):
+        """
+        Classify stage: build the document and classify its tags (ANS-110, NFT, UDL)
+        """
+        page = job.pop("page")
         doc = {
-            "txid": tx["txid"],
-            "tags": tags,
-            "content": content
+            "txid": job["tx"]["txid"],
+            "tags": job["tags"],
+            "content": page.pop("content", None),
+            "indexed_at": datetime.datetime.now(datetime.timezone.utc),
         }
-        self.indexer.index_document(doc)
-        # mark the TX as crawled
-        self.frontier.mark_tx_crawled(tx)
+        # page_title, page_description and links of HTML pages
+        doc.update(page)
+        if "content_hash" in job:
+            doc["content_hash"] = job["content_hash"]
+        if "canonical" in job:
+            # duplicate body: search leaves this document out, its title/description/topics
+            # are added to the canonical document instead (see AsyncIndexer.add_duplicate)
+            doc["canonical"] = job["canonical"]
+        classify(doc)
+        job["doc"] = doc
+        return job
 
-    def crawl_lifecycle(self, block_no=None):
+    async def index(self, job):
         """
-        Crawl lifecycle
+        Index stage: hand the document to the bulk indexer, and mark the TX as crawled
+        in the frontier once the indexer acknowledged it
+        """
+        doc = job["doc"]
+        indexed = [await self.indexer.index_document(doc)]
+        if "canonical" in doc:
+            indexed.append(await self.indexer.add_duplicate(doc))
+        task = asyncio.create_task(self.mark_when_indexed(job["tx"], indexed, doc))
+        self.marking.add(task)
+        task.add_done_callback(self.marking.discard)
+
+    def stage_error(self, stage, job, e):
+        """
+        Drop a TX that failed in a stage, keeping the lease so it's retried once it expires
+        """
+        log.warning("Error in %s stage for TX: %s %r", stage, job["tx"]["txid"], e)
+        self.in_flight.pop(job["tx"]["txid"], None)
+
+    def gauges(self):
+        """
+        Pipeline, tag lookup and bulk indexer state, for metrics.render()
+        """
+        gauges = []
+        for stage in self.stages:
+            labels = {"stage": stage.name}
+            gauges.append(("crawler_stage_queued", labels, stage.queue.qsize()))
+            gauges.append(("crawler_stage_workers", labels, stage.workers))
+            gauges.append(("crawler_stage_processed", labels, stage.processed))
+            gauges.append(("crawler_stage_errors", labels, stage.errors))
+            gauges.append(("crawler_stage_busy_seconds", labels, round(stage.busy_seconds, 3)))
+        gauges.append(("crawler_in_flight", {}, len(self.in_flight)))
+        for stat, value in self.stats.items():
+            gauges.append(("crawler_" + stat, {}, value))
+        for stat, value in self.indexer.bulk.stats.items():
+            gauges.append(("crawler_bulk_" + stat, {}, value))
+        return gauges
+
+    def stage_stats(self):
+        """
+        Stats of each pipeline stage, by name
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
+
+    async def feed(self, queue, block_no=None):
+        """
+        Feed stage: keep the first stage's queue topped up with TXs leased from the frontier
         """
-        crawler = Crawler()
-        print("Crawler: Init crawl lifecycle")
         while True:
-            crawler.crawl(block_no)
+            room = queue.maxsize - queue.qsize()
+            if room == 0:
+                await asyncio.sleep(0.1)
+                continue
+            txs = await self.frontier.claim_txs(room, block_no)
+            if len(txs) == 0:
+                if len(self.in_flight) == 0:
+                    log.info("No TXs to crawl")
+                await asyncio.sleep(1)
+                continue
+            for tx in txs:
+                self.in_flight[tx["txid"]] = tx
+            try:
+                await self.fetch_tags(txs)
+            except Exception as e:
+                # crawl falls back to per-TX metadata queries
+                log.warning("Error fetching tags: %r", e)
+            for tx in txs:
+                await queue.put({"tx": tx})
+
+    async def fetch_tags(self, txs):
+        """
+        Attach tags to claimed TXs, in one batched query for those the frontier has no tags for
+        """
+        missing = [tx["txid"] for tx in txs if tx.get("tags") is None]
+        self.stats["tags_from_frontier"] += len(txs) - len(missing)
+        if len(missing) == 0:
+            return
+        tags = await self.arweave.get_txs_tags(missing)
+        self.stats["tags_from_network"] += len(tags)
+        self.stats["tag_queries"] += -(-len(missing) // MAX_PAGE_SIZE)
+        for tx in txs:
+            if tx.get("tags") is None and tx["txid"] in tags:
+                tx["tags"] = tags[tx["txid"]]
+
+    async def report(self):
+        """
+        Periodically print crawl stats
+        """
+        while True:
+            await asyncio.sleep(self.report_seconds)
+            print("Crawler: Stats:", self.stats, "bulk:", self.indexer.bulk.stats)
+            for name, stats in self.stage_stats().items():
+                print("Crawler: Stage %-8s" % name, stats)
+
+    async def keep_leases(self):
+        """
+        Renew the leases on queued and in-progress TXs, and reclaim expired ones
+        """
+        while True:
+            await asyncio.sleep(self.frontier.lease_seconds / 3)
+            if self.in_flight:
+                await self.frontier.renew_leases(list(self.in_flight.values()))
+            await self.frontier.reclaim_expired_leases()
+
+    async def mark_when_indexed(self, tx, indexed, doc=None):
+        """
+        Mark a TX as crawled once the indexer acknowledged its writes (futures in `indexed`)
+        """
+        try:
+            if all(await asyncio.gather(*indexed)):
+                await self.frontier.mark_tx_crawled(tx)
+            else:
+                # keep the lease so the TX is retried once it expires
+                log.warning("Error indexing TX: %s", tx["txid"])
+                if doc is not None and "content_hash" in doc and "canonical" not in doc:
+                    # don't leave duplicates pointing at a document that doesn't exist
+                    await self.frontier.release_content_hash(doc["content_hash"], tx["txid"])
+        finally:
+            self.in_flight.pop(tx["txid"], None)
+
+    async def crawl_lifecycle(self, block_no=None):
+        """
+        Crawl lifecycle
+        """
+        print("Crawler: Init crawl lifecycle, stages:",
+              ", ".join("%s x%d" % (stage.name, stage.workers) for stage in self.stages))
+        # SIGTERM shuts down like Ctrl-C, flushing buffered documents first
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
+        )
+        server = None
+        if self.metrics_port:
+            server = await metrics.serve(self.metrics_port)
+        async with self.arweave:
+            # independent round trips, run them together
+            await asyncio.gather(
+                self.frontier.test_db(),
+                self.frontier.init_indexes(),
+                self.indexer.init_index(),
+            )
+            tasks = [
+                asyncio.create_task(self.feed(self.stages[0].queue, block_no)),
+                asyncio.create_task(self.keep_leases()),
+                asyncio.create_task(self.report()),
+            ]
+            for stage in self.stages:
+                for _ in range(stage.workers):
+                    tasks.append(asyncio.create_task(stage.work(self.stage_error)))
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # flush buffered documents and mark the ones that made it
+                await self.indexer.close()
+                if self.marking:
+                    await asyncio.gather(*self.marking)
+                # hand unfinished TXs back to the other workers
+                if self.in_flight:
+                    await self.frontier.release_leases(list(self.in_flight.values()))
+                self.frontier.close()
+                self.parse_pool.shutdown(cancel_futures=True)
+                if server is not None:
+                    server.close()
+                    await server.wait_closed()
 
 
 def main(block_no=None):
     # load_dotenv()
     crawler = Crawler()
-    crawler.crawl_lifecycle(block_no)
+    asyncio.run(crawler.crawl_lifecycle(block_no))
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         block_no = sys.argv[1]
         main(block_no)
     else:
-        main()
\ No newline at end of file
+        main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+extractor.py
+
+HTML to text extraction for crawled pages. extract() runs a streaming HTMLParser over
+the page and returns the visible text, the <title>, the meta description and outgoing
+links, dropping markup, scripts and styles. It only depends on the standard library
+and is picklable, so the crawler runs it in a process pool.
+"""
+
+import sys
+import re
+from html.parser import HTMLParser
+
+
+# elements whose text is never visible
+SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "iframe", "object"}
+# elements that break the text flow
+BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+              "section", "article", "header", "footer", "nav", "blockquote", "pre", "td", "th"}
+
+FEED_CHUNK_SIZE = 8 * 1024
+MAX_LINKS = 100
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class TextExtractor(HTMLParser):
+    """
+    Collects the text, title, meta description and links of an HTML page
+    """
+
+    def __init__(self, max_text=None):
+        """
+        Constructor
+        """
+        super().__init__(convert_charrefs=True)
+        self.max_text = max_text
+        self.parts = []
+        self.text_length = 0
+        self.title_parts = []
+        self.description = None
+        self.links = []
+        self.skip_depth = 0
+        self.in_title = False
+
+    @property
+    def full(self):
+        return self.max_text is not None and self.text_length >= self.max_text
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "title":
+            self.in_title = True
+        elif tag == "meta":
+            attrs = dict(attrs)
+            name = (attrs.get("name") or attrs.get("property") or "").lower()
+            if name in ("description", "og:description") and self.description is None:
+                self.description = attrs.get("content")
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href and len(self.links) < MAX_LINKS and not href.startswith(("#", "javascript:")):
+                if href not in self.links:
+                    self.links.append(href)
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == "title":
+            self.in_title = False
+        if tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.in_title:
+            self.title_parts.append(data)
+            return
+        if self.full:
+            return
+        if data.isspace():
+            # keeps inline elements apart, collapsed again in result()
+            self.parts.append(" ")
+        else:
+            self.parts.append(data)
+            self.text_length += len(data)
+
+    def result(self):
+        """
+        Return the extracted fields
+        """
+        lines = (WHITESPACE.sub(" ", line).strip() for line in "".join(self.parts).split("\n"))
+        text = "\n".join(line for line in lines if line)
+        if self.max_text is not None:
+            text = text[: self.max_text]
+        title = WHITESPACE.sub(" ", "".join(self.title_parts)).strip()
+        description = WHITESPACE.sub(" ", self.description).strip() if self.description else None
+        return {
+            "content": text,
+            "page_title": title or None,
+            "page_description": description or None,
+            "links": self.links,
+        }
+
+
+def extract(html, max_text=None):
+    """
+    Extract the text, title, meta description and links of an HTML page
+    """
+    parser = TextExtractor(max_text)
+    for i in range(0, len(html), FEED_CHUNK_SIZE):
+        parser.feed(html[i : i + FEED_CHUNK_SIZE])
+        # the title and meta tags come first, stop parsing once the text is full
+        if parser.full:
+            break
+    else:
+        parser.close()
+    return parser.result()
+
+
+if __name__ == "__main__":
+    import json
+    with open(sys.argv[1], encoding="utf-8", errors="replace") as f:
+        print(json.dumps(extract(f.read()), indent=4))
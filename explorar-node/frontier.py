@@ -7,7 +7,10 @@ This file contains the frontier class, which is responsible for managing the fro
 A frontier is a queue of URLs to be crawled. The frontier is responsible for managing the queue, and
 for ensuring that URLs are not crawled more than once.
 
-The file also contains a function to populate the frontier with seed URLs. This function is called
+The file also contains the backfill engine that populates the frontier with the TXs of a block
+range, fetching chunks of the range concurrently and resuming interrupted chunks from a cursor
+saved in the "backfill" collection. populate_frontier() backfills the latest 50 blocks, and
+follow_tip() runs continuously, ingesting new blocks as they are mined.
 
 
 All URLs are stored in a mongodb database. The database has a single collection, called "urls".
@@ -15,10 +18,38 @@ Each document in the collection has the following fields:
 - url: URL of the page
 - block_no: Block number of the page/artx
 - crawled_at: Timestamp of when the document was crawled
+- tags: Tags of the TX, captured from the GraphQL page it was ingested from
 
-The frontier has two methods:
-- get_next_url(): Returns the next URL to crawl
-- mark_url_crawled(url): Marks the URL as crawled
+txid carries a unique index, so a page of TXs is ingested as one unordered bulk upsert.
+Set FRONTIER_BULK_INGEST=0 to fall back to the per-TX count + insert path, which is also
+taken when the unique index can't be built (a collection that already has duplicate txids).
+
+Several crawler processes can share one frontier. A worker claims TXs by atomically setting
+- leased_by: Id of the worker (host:pid) holding the TX
+- lease_expires: Time after which the lease may be taken over by another worker
+on uncrawled TXs whose lease is missing or expired. Workers renew leases on TXs that are still
+in progress, and marking a TX as crawled clears its lease. A TX is done once crawled_at is set,
+whoever holds the lease.
+
+Claims are handed out in the order of a scheduling policy (FRONTIER_POLICY):
+- oldest: lowest block_no first
+- newest: highest block_no first, for keeping up with the chain tip
+- priority: highest priority first, where priority is derived at ingest from the TX tags
+  (see PRIORITY_MARKERS), so likely-HTML and ANS-110 TXs are crawled first
+The indexes serving each policy are created and verified when a frontier starts.
+
+Backfills and the tip follower ingest through an in-memory membership layer (membership.py):
+an LRU of recent txids plus a Bloom filter of all of them, persisted to FRONTIER_BLOOM_PATH,
+so TXs the frontier already has are mostly skipped without a database round trip.
+Its hit and false positive counts are exported as frontier_membership_* gauges, which the
+tip follower serves on FRONTIER_METRICS_PORT when set.
+
+AsyncFrontier has these methods:
+- claim_txs(k): Claims up to k TXs to crawl
+- renew_leases(txs): Extends the leases held on TXs
+- release_leases(txs): Gives up leases without marking the TXs as crawled
+- reclaim_expired_leases(): Clears leases left behind by dead workers
+- mark_tx_crawled(tx): Marks the TX as crawled
 
 """
 
@@ -29,233 +60,637 @@ import json
 from dotenv import load_dotenv
 import asyncio
 import datetime
-from pymongo import MongoClient
+import socket
+import uuid
+from pymongo import UpdateOne, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure, DuplicateKeyError
+from clients import get_mongo, close_mongo
+from arweave import ArweaveClient, MAX_PAGE_SIZE
+from classifier import classify_tags
+from membership import KnownTxids
+import metrics
+
+log = metrics.get_logger("Frontier")
+CLAIM_SECONDS = metrics.histogram("frontier_claim_seconds", "Frontier claim latency")
+CLAIMED = metrics.counter("frontier_claimed_txs_total", "TXs leased from the frontier")
+MARK_SECONDS = metrics.histogram("frontier_mark_seconds", "Frontier mark-as-crawled latency")
 
-# graphql client
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
 
+# indexes created and verified at startup
+FRONTIER_INDEXES = [
+    {"name": "txid_unique", "keys": [("txid", ASCENDING)], "unique": True},
+    # claims: equality on crawled_at, then the scheduling policy's sort
+    {"name": "claim_block", "keys": [("crawled_at", ASCENDING), ("block_no", ASCENDING)]},
+    {
+        "name": "claim_priority",
+        "keys": [("crawled_at", ASCENDING), ("priority", DESCENDING), ("block_no", ASCENDING)],
+    },
+    # batch claim read-back and expired lease reclaiming
+    {"name": "lease_id", "keys": [("lease_id", ASCENDING)], "sparse": True},
+    {"name": "lease_expires", "keys": [("lease_expires", ASCENDING)], "sparse": True},
+]
 
-class Frontier:
+# scheduling policy -> sort order of claims, each served by a claim_* index
+SCHEDULING_POLICIES = {
+    "oldest": [("block_no", ASCENDING)],
+    "newest": [("block_no", DESCENDING)],
+    "priority": [("priority", DESCENDING), ("block_no", ASCENDING)],
+}
+
+# classifier marker -> crawl priority of TXs carrying it, for the "priority" policy
+PRIORITY_MARKERS = {
+    "ANS-110": 3,
+    "HTML": 2,
+    "App:Permapages": 2,
+    "JSON": 1,
+}
+
+
+def tx_priority(tags):
     """
-    Frontier class
+    Crawl priority of a TX from its tags, higher is crawled first
     """
+    markers = classify_tags(tags)["markers"] or []
+    return max([PRIORITY_MARKERS.get(marker, 0) for marker in markers], default=0)
 
-    def __init__(self):
+
+def scheduling_sort(policy=None):
+    """
+    Sort order of claims for a scheduling policy, FRONTIER_POLICY by default
+    """
+    policy = policy or os.getenv("FRONTIER_POLICY", "oldest")
+    if policy not in SCHEDULING_POLICIES:
+        raise ValueError("Unknown scheduling policy: %s" % policy)
+    return SCHEDULING_POLICIES[policy]
+
+
+def create_index_args(index):
+    """
+    create_index() keyword arguments of a FRONTIER_INDEXES entry
+    """
+    return {k: v for k, v in index.items() if k != "keys"}
+
+
+def missing_indexes(index_information):
+    """
+    Names of FRONTIER_INDEXES that are absent or have different keys
+    """
+    missing = []
+    for index in FRONTIER_INDEXES:
+        info = index_information.get(index["name"])
+        if info is None or [tuple(k) for k in info["key"]] != index["keys"]:
+            missing.append(index["name"])
+    return missing
+
+
+def default_worker_id():
+    """
+    Id a worker leases TXs under
+    """
+    return socket.gethostname() + ":" + str(os.getpid())
+
+
+def utcnow():
+    """
+    Current time in UTC, for every timestamp the frontier stores or compares
+
+    Leases are compared across crawler hosts, so their clocks must agree on the
+    zone; host clocks should still be NTP synced, skew shortens or extends leases.
+    """
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def claimable_query(now, block_no=None):
+    """
+    Query for uncrawled TXs that are not leased by a live worker
+    """
+    query = {
+        "crawled_at": None,
+        "$or": [{"lease_expires": None}, {"lease_expires": {"$lt": now}}],
+    }
+    if block_no is not None:
+        query["block_no"] = int(block_no)
+    return query
+
+
+def lease_update(worker_id, lease_seconds, now, lease_id=None):
+    """
+    Update that (re)leases TXs to a worker
+    """
+    fields = {
+        "leased_by": worker_id,
+        "lease_expires": now + datetime.timedelta(seconds=lease_seconds),
+    }
+    if lease_id is not None:
+        fields["lease_id"] = lease_id
+    return {"$set": fields}
+
+
+def frontier_doc(tx):
+    """
+    Build the frontier document for an ingested TX
+    """
+    doc = {
+        "txid": tx["id"],
+        "block_no": tx["block_no"],
+        "crawled_at": None,
+    }
+    # tags captured from the GraphQL page save the crawler a metadata query
+    if tx.get("tags") is not None:
+        doc["tags"] = tx["tags"]
+        doc["priority"] = tx_priority(tx["tags"])
+    return doc
+
+
+def ingest_ops(txs):
+    """
+    Bulk upserts that insert the TXs the frontier doesn't know yet
+
+    block_no is always set, so a TX that moved to another block in a reorg follows it.
+    """
+    ops = []
+    for tx in txs:
+        doc = frontier_doc(tx)
+        block_no = doc.pop("block_no")
+        ops.append(
+            UpdateOne(
+                {"txid": tx["id"]},
+                {"$setOnInsert": doc, "$set": {"block_no": block_no}},
+                upsert=True,
+            )
+        )
+    return ops
+
+
+def duplicate_upserts(e):
+    """
+    Number of upserts a BulkWriteError reports as inserted, if its only errors are
+    duplicate keys. Concurrent upserts of the same txid race on the unique index,
+    and the losing side is already known, so those are not failures.
+    """
+    errors = [err for err in e.details["writeErrors"] if err["code"] != 11000]
+    if errors:
+        raise e
+    return e.details["nUpserted"]
+
+
+RELEASE_UPDATE = {"$unset": {"leased_by": "", "lease_expires": "", "lease_id": ""}}
+
+
+class AsyncFrontier:
+    """
+    Asyncio frontier backed by motor, used by the crawler and the backfill engine
+    """
+
+    def __init__(self, collection_name="artx", policy=None):
         """
         Constructor
         """
         load_dotenv()
-        self.client = None
-        self.db = None
-        self.collection = None
-        self.init_db()
-        self.test_db()
-
-    def init_db(self):
-        """
-        Initialize the database connection
-        """
-        # connect to the client, using the environment variables MONGODB_HOST, MONGODB_PORT, MONGODB_DATABASE, MONGODB_USER and MONGODB_PASSWORD
-        self.client = MongoClient(
-            "mongodb://"
-            + os.getenv("MONGODB_USER")
-            + ":"
-            + os.getenv("MONGODB_PASSWORD")
-            + "@"
-            + os.getenv("MONGODB_HOST")
-            + ":"
-            + os.getenv("MONGODB_PORT")
-        )
-        # connect to server
-        self.client.server_info()
-        print("Frontier: Connected to MongoDB server")
-        # get database, print collection names
-        try:
-            self.db = self.client[os.getenv("MONGODB_DATABASE")]
-            print("Database:", self.db)
-            # print("Collections:", self.db.list_collection_names())
-        except:
-            print("Error getting database")
-            sys.exit(1)
-        # get collection, if it doesn't exist, create it
-        try:
-            self.collection = self.db["artx"]
-            print("Collection exists:", self.collection)
-        except:
-            print("Error getting collection")
-            sys.exit(1)
+        self.client = get_mongo()
+        self.db = self.client[os.getenv("MONGODB_DATABASE")]
+        self.collection = self.db[collection_name]
+        # content hash -> txid of the first TX with that body, keyed by _id
+        self.content_hashes = self.db["content_hashes"]
+        self.sort = scheduling_sort(policy)
+        # bulk upserts need the unique txid index, fall back to per-tx ingest without it
+        self.bulk_ingest = os.getenv("FRONTIER_BULK_INGEST", "1") == "1"
+        # membership layer for ingest, see init_membership
+        self.known = None
+        self.verify_known = os.getenv("FRONTIER_BLOOM_VERIFY", "1") == "1"
+        self.worker_id = default_worker_id()
+        self.lease_seconds = int(os.getenv("FRONTIER_LEASE_SECONDS", "300"))
 
-    def test_db(self):
+    async def test_db(self):
         """
         Test the database connection
         """
-        print("MongoDB version:", self.client.server_info()["version"])
+        info = await self.client.server_info()
+        print("MongoDB version:", info["version"])
+
+    async def init_indexes(self):
+        """
+        Create the indexes the frontier relies on, and verify they are in place
+        """
+        for index in FRONTIER_INDEXES:
+            try:
+                await self.collection.create_index(index["keys"], **create_index_args(index))
+            except OperationFailure as e:
+                print("Frontier: Could not create index", index["name"] + ":", e)
+        missing = missing_indexes(await self.collection.index_information())
+        if missing:
+            print("Frontier: Missing or mismatched indexes:", missing)
+        if "txid_unique" in missing and self.bulk_ingest:
+            # an existing collection with duplicate txids can't get the unique index
+            print("Frontier: Falling back to single-tx ingest")
+            self.bulk_ingest = False
+        return missing
+
+    async def init_membership(self):
+        """
+        Seed the in-memory membership layer, so ingest can skip TXs it already knows
+        """
+        self.known = KnownTxids()
+        await self.known.seed(self.collection)
+        metrics.add_collector(self.membership_gauges)
+
+    async def filter_known(self, txs):
+        """
+        Drop the TXs the membership layer says the frontier already has
+
+        Recently seen txids are dropped outright. Bloom filter hits are checked with
+        one query for the whole batch (FRONTIER_BLOOM_VERIFY=1, the default) and
+        counted as false positives if absent, or trusted as known otherwise.
+        """
+        (known, new, maybe) = self.known.split([tx["id"] for tx in txs])
+        if maybe and self.verify_known:
+            cursor = self.collection.find({"txid": {"$in": maybe}}, {"txid": 1, "_id": 0})
+            found = {doc["txid"] async for doc in cursor}
+            self.known.stats["false_positives"] += len(maybe) - len(found)
+            new.extend(txid for txid in maybe if txid not in found)
+        new = set(new)
+        return [tx for tx in txs if tx["id"] in new]
 
-    def ingest_txs(self, txs):
+    async def ingest_txs(self, txs, bulk=None):
         """
-        Ingest a list of TXs/URLs into the frontier
+        Ingest a batch of TXs with a single unordered bulk upsert, or one TX at a
+        time with bulk=False (bulk_ingest by default)
+
+        With the membership layer, TXs known to be in the frontier are skipped
+        without writing them. Their block_no is then not updated if a reorg
+        moved them.
+
+        Returns a tuple of (inserted, known) counts
+        """
+        if len(txs) == 0:
+            return (0, 0)
+        unknown = txs
+        if self.known is not None:
+            unknown = await self.filter_known(txs)
+        if bulk is None:
+            bulk = self.bulk_ingest
+        inserted = 0
+        if unknown and bulk:
+            try:
+                result = await self.collection.bulk_write(ingest_ops(unknown), ordered=False)
+                inserted = result.upserted_count
+            except BulkWriteError as e:
+                inserted = duplicate_upserts(e)
+        elif unknown:
+            inserted = await self.ingest_txs_single(unknown)
+        if self.known is not None:
+            self.known.add([tx["id"] for tx in txs])
+        return (inserted, len(txs) - inserted)
+
+    async def ingest_txs_single(self, txs):
+        """
+        Ingest TXs one at a time (count + insert per TX), returns the number inserted
         """
+        inserted = 0
         for tx in txs:
-            # if the URL is not in the database, add it
-            if self.collection.count_documents({"txid": tx["id"]}) == 0:
-                # add the URL to the database
-                self.collection.insert_one(
-                    {
-                        "txid": tx["id"],
-                        "block_no": tx["block_no"],
-                        "crawled_at": None,
-                    }
+            if await self.collection.count_documents({"txid": tx["id"]}) == 0:
+                await self.collection.insert_one(frontier_doc(tx))
+                inserted += 1
+                if metrics.sampled(log):
+                    log.debug("Added URL to database: %s", tx["id"])
+            elif metrics.sampled(log):
+                log.debug("URL already in database: %s", tx["id"])
+        return inserted
+
+    def save_membership(self, force=False):
+        """
+        Persist the membership layer's Bloom filter
+        """
+        if self.known is None:
+            return
+        if force:
+            self.known.save()
+        elif not self.known.maybe_save():
+            return
+        print("Frontier: Membership stats:", self.membership_stats())
+
+    def membership_stats(self):
+        """
+        Stats of the membership layer (see KnownTxids.report), empty without one
+        """
+        return self.known.report() if self.known is not None else {}
+
+    def membership_gauges(self):
+        """
+        Membership stats as frontier_membership_* gauges, for metrics.add_collector
+        """
+        return [("frontier_membership_" + name, {}, value)
+                for name, value in self.membership_stats().items()]
+
+    async def claim_txs(self, k, block_no=None):
+        """
+        Atomically lease up to k uncrawled TXs to this worker, in scheduling policy order
+        """
+        with CLAIM_SECONDS.time():
+            now = utcnow()
+            if k == 1:
+                tx = await self.collection.find_one_and_update(
+                    claimable_query(now, block_no),
+                    lease_update(self.worker_id, self.lease_seconds, now),
+                    sort=self.sort,
+                    return_document=ReturnDocument.AFTER,
                 )
-                print("Frontier: Added URL to database:", tx["id"])
-            else:
-                print("Frontier: URL already in database:", tx["id"])
-        print("Frontier: Ingested", len(txs), "URLs")
+                txs = [] if tx is None else [tx]
+                CLAIMED.inc(len(txs))
+                return txs
+            # pick candidates, then lease them under a fresh lease id. The update re-checks
+            # the claimable filter per document, so a TX another worker grabbed in between
+            # is skipped rather than stolen.
+            cursor = self.collection.find(
+                claimable_query(now, block_no), {"_id": 1}, sort=self.sort, limit=k
+            )
+            ids = [tx["_id"] async for tx in cursor]
+            if len(ids) == 0:
+                return []
+            lease_id = uuid.uuid4().hex
+            query = claimable_query(now, block_no)
+            query["_id"] = {"$in": ids}
+            await self.collection.update_many(
+                query, lease_update(self.worker_id, self.lease_seconds, now, lease_id)
+            )
+            cursor = self.collection.find({"lease_id": lease_id}, sort=self.sort)
+            txs = await cursor.to_list(length=k)
+            CLAIMED.inc(len(txs))
+            return txs
 
-    def get_next_tx(self, block_no=None, repeat=False):
+    async def renew_leases(self, txs):
         """
-        Get the next TX to crawl
+        Extend this worker's leases on TXs that are still being crawled
         """
-        # find the oldest TX that has not been crawled
-        query = {"crawled_at": None}
-        if block_no is not None:
-            query["block_no"] = int(block_no)
-        tx = self.collection.find_one(query, sort=[("block_no", 1)])
-        if tx is None:
-            print("Frontier: No TXs to crawl")
-            return None
-        else:
-            print("Frontier: Next TX to crawl:", tx["txid"])
-            return tx
+        now = utcnow()
+        result = await self.collection.update_many(
+            {
+                "txid": {"$in": [tx["txid"] for tx in txs]},
+                "leased_by": self.worker_id,
+                "crawled_at": None,
+            },
+            lease_update(self.worker_id, self.lease_seconds, now),
+        )
+        return result.modified_count
 
-    def mark_tx_crawled(self, tx):
+    async def release_leases(self, txs):
         """
-        Mark a TX as crawled
+        Give up this worker's leases without marking the TXs as crawled
         """
-        # mark the TX as crawled
-        self.collection.update_one(
-            {"txid": tx["txid"]}, {"$set": {"crawled_at": datetime.datetime.now()}}
+        result = await self.collection.update_many(
+            {"txid": {"$in": [tx["txid"] for tx in txs]}, "leased_by": self.worker_id},
+            RELEASE_UPDATE,
         )
-        print("Frontier: Marked TX as crawled:", tx["txid"])
+        return result.modified_count
 
+    async def reclaim_expired_leases(self):
+        """
+        Clear expired leases on uncrawled TXs, e.g. from crashed workers
+        """
+        result = await self.collection.update_many(
+            {"crawled_at": None, "lease_expires": {"$lt": utcnow()}},
+            RELEASE_UPDATE,
+        )
+        if result.modified_count:
+            print("Frontier: Reclaimed", result.modified_count, "expired leases")
+        return result.modified_count
+
+    async def claim_content_hash(self, content_hash, txid):
+        """
+        Record txid as the canonical TX for a content hash, unless another TX has it
+
+        Returns the canonical txid of the content: txid itself if it's the first TX
+        seen with it, or the txid it was first seen with.
+        """
+        update = {"$setOnInsert": {"txid": txid, "first_seen": utcnow()}}
+        try:
+            doc = await self.content_hashes.find_one_and_update(
+                {"_id": content_hash}, update, upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # lost a race with a concurrent upsert of the same hash
+            doc = await self.content_hashes.find_one({"_id": content_hash})
+        return doc["txid"]
+
+    async def release_content_hash(self, content_hash, txid):
+        """
+        Drop txid's claim on a content hash, e.g. when its document failed to index,
+        so the next TX with that content becomes canonical instead
+        """
+        await self.content_hashes.delete_one({"_id": content_hash, "txid": txid})
+
+    async def mark_tx_crawled(self, tx):
+        """
+        Mark a TX as crawled
+        """
+        update = {"$set": {"crawled_at": utcnow()}}
+        update.update(RELEASE_UPDATE)
+        with MARK_SECONDS.time():
+            await self.collection.update_one({"txid": tx["txid"]}, update)
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        close_mongo()
 
-def populate_frontier(frontier, block_no=None):
+
+async def backfill_chunk(frontier, arweave, min_block, max_block, page_size, resume=True):
     """
-    Populate the frontier with seed URLs (arweave TXs)
-    by connecting to the arweave node using graphql and
-    querying for the latest block number, then querying
-    for the latest 1000 blocks, and ingesting all the TXs
-    in those blocks into the frontier.
+    Ingest all TXs in blocks min_block..max_block, page by page
 
+    The cursor of the last ingested page is saved in the "backfill" collection, so an
+    interrupted chunk picks up after it, and a completed chunk is skipped. With
+    resume=False the chunk is always fetched in full and no cursor is kept.
     """
-    # get the frontier
-    if frontier is None:
-        frontier = Frontier()
-    # connect to the arweave node
-    load_dotenv()
-    # initialize graphql client
-    transport = AIOHTTPTransport(
-        url=os.getenv("ARWEAVE_GQL_HOST") + "/graphql",
-        headers={"User-Agent": "Python-arweave"},
-    )
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-    print("Connected to Arweave node")
-    # get the latest block number
-    query = """
-    query {
-        blocks(first: 1) {
-            edges {
-                node {
-                    height
-                }
+    state = frontier.db["backfill"]
+    chunk_id = "%d-%d" % (min_block, max_block)
+    cursor = None
+    if resume:
+        saved = await state.find_one({"_id": chunk_id})
+        if saved is not None:
+            if saved.get("done"):
+                return (0, 0)
+            cursor = saved.get("cursor")
+    inserted = 0
+    known = 0
+    while True:
+        result = await arweave.get_block_txs(min_block, max_block, page_size, cursor)
+        edges = result["edges"]
+        txs = [
+            {
+                "id": edge["node"]["id"],
+                "block_no": edge["node"]["block"]["height"],
+                "tags": edge["node"]["tags"],
             }
-        }
-    }
+            for edge in edges
+        ]
+        # ingest the transactions into the frontier
+        (new, old) = await frontier.ingest_txs(txs)
+        inserted += new
+        known += old
+        if edges:
+            cursor = edges[-1]["cursor"]
+        done = not result["pageInfo"]["hasNextPage"]
+        if resume:
+            await state.update_one(
+                {"_id": chunk_id},
+                {"$set": {"cursor": cursor, "done": done, "updated_at": utcnow()}},
+                upsert=True,
+            )
+        if done:
+            break
+    print("Frontier: Blocks", chunk_id, "ingested:", inserted, "new,", known, "known")
+    return (inserted, known)
+
+
+async def backfill(min_block, max_block, frontier=None, arweave=None, resume=True):
     """
-    result = client.execute(gql(query))
-    # get the block number
-    height = None
-    if block_no is None:
-        height = result["blocks"]["edges"][0]["node"]["height"]
-    else:
-        height = int(block_no)
-    print("Block number:", height)
-    # get the transactions for the latest 50 blocks
-    for i in range(height, height - 50, -1):
-        print("Getting transactions for block", i)
-        query = (
-            """
-        query {
-            transactions(block: {min: """
-            + str(i)
-            + """, max: """
-            + str(i)
-            + """}, first: 100) {
-                edges {
-                    node {
-                        id
-                        block {
-                            height
-                        }
-                    }
-                    cursor
-                }
-                pageInfo {
-                    hasNextPage
-                }
-            }
-        }
-        """
-        )
-        while True:
-            result = client.execute(gql(query))
-            # get the transactions
-            txs = []
-            for tx in result["transactions"]["edges"]:
-                txs.append(
-                    {"id": tx["node"]["id"], "block_no": tx["node"]["block"]["height"]}
-                )
-            # ingest the transactions into the frontier
-            frontier.ingest_txs(txs)
-            # if there is a next page, get the next page
-            if result["transactions"]["pageInfo"]["hasNextPage"]:
-                query = (
-                    """
-                query {
-                    transactions(block: {min: """
-                    + str(i)
-                    + """, max: """
-                    + str(i)
-                    + """}, first: 100, after: \""""
-                    + tx["cursor"]
-                    + """\") {
-                        edges {
-                            node {
-                                id
-                                block {
-                                    height
-                                }
-                            }
-                            cursor
-                        }
-                        pageInfo {
-                            hasNextPage
-                        }
-                    }
-                }
-                """
-                )
-            else:
-                break
-    frontier.ingest_txs(txs)
+    Ingest all TXs in blocks min_block..max_block into the frontier
+
+    The range is split into chunks of BACKFILL_CHUNK_BLOCKS blocks, of which up to
+    BACKFILL_PARALLELISM are fetched concurrently. Each chunk is paged through with
+    a parameterized query of BACKFILL_PAGE_SIZE TXs per page, so sparse blocks still
+    fill whole pages, and keeps its own resumable cursor.
+    """
+    load_dotenv()
+    chunk_blocks = int(os.getenv("BACKFILL_CHUNK_BLOCKS", "10"))
+    parallelism = int(os.getenv("BACKFILL_PARALLELISM", "4"))
+    page_size = int(os.getenv("BACKFILL_PAGE_SIZE", str(MAX_PAGE_SIZE)))
+    own_frontier = frontier is None
+    if own_frontier:
+        frontier = AsyncFrontier()
+        await frontier.init_indexes()
+        await frontier.init_membership()
+    own_arweave = arweave is None
+    if own_arweave:
+        arweave = await ArweaveClient().open()
+    slots = asyncio.Semaphore(parallelism)
+
+    async def run(lo, hi):
+        async with slots:
+            return await backfill_chunk(frontier, arweave, lo, hi, page_size, resume)
+
+    try:
+        chunks = [
+            (lo, min(lo + chunk_blocks - 1, max_block))
+            for lo in range(min_block, max_block + 1, chunk_blocks)
+        ]
+        print("Frontier: Backfilling blocks", min_block, "to", max_block, "in", len(chunks), "chunks")
+        tasks = [asyncio.create_task(run(lo, hi)) for lo, hi in chunks]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # a failed chunk fails the backfill, stop the others before closing the clients
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        inserted = sum(r[0] for r in results)
+        known = sum(r[1] for r in results)
+        print("Frontier: Backfill done:", inserted, "new,", known, "known")
+        if frontier.known is not None:
+            print("Frontier: Membership stats:", frontier.membership_stats())
+        return (inserted, known)
+    finally:
+        if own_arweave:
+            await arweave.close()
+        if own_frontier:
+            frontier.save_membership(force=True)
+            frontier.close()
+
+
+async def backfill_latest(blocks=50, block_no=None):
+    """
+    Backfill the `blocks` blocks up to block_no, or up to the latest block
+    """
+    async with ArweaveClient() as arweave:
+        height = int(block_no) if block_no is not None else await arweave.get_height()
+        print("Block number:", height)
+        return await backfill(height - blocks + 1, height, arweave=arweave)
+
+
+async def follow_tip():
+    """
+    Keep ingesting new blocks as the chain grows
+
+    Polls the latest height every FOLLOW_POLL_SECONDS and ingests only the blocks
+    above the high-water mark kept in the "state" collection, plus the
+    FOLLOW_REORG_DEPTH blocks below it, which may have been replaced by a short
+    reorg since they were ingested. Without a saved high-water mark it starts at
+    the current tip.
+    """
+    load_dotenv()
+    poll_seconds = float(os.getenv("FOLLOW_POLL_SECONDS", "5"))
+    reorg_depth = int(os.getenv("FOLLOW_REORG_DEPTH", "5"))
+    report_seconds = float(os.getenv("FOLLOW_REPORT_SECONDS", "60"))
+    reported = time.monotonic()
+    metrics_port = int(os.getenv("FRONTIER_METRICS_PORT", "0"))
+    server = await metrics.serve(metrics_port) if metrics_port else None
+    frontier = AsyncFrontier()
+    await frontier.init_indexes()
+    await frontier.init_membership()
+    state = frontier.db["state"]
+    saved = await state.find_one({"_id": "tip"})
+    high_water = saved["height"] if saved is not None else None
+    print("Frontier: Following the chain tip from", high_water)
+    try:
+        async with ArweaveClient() as arweave:
+            while True:
+                try:
+                    height = await arweave.get_height()
+                    if high_water is None:
+                        high_water = height - 1
+                    if height > high_water:
+                        start = max(high_water - reorg_depth + 1, 0)
+                        # the re-scanned blocks are always fetched in full
+                        await backfill(start, height, frontier, arweave, resume=False)
+                        high_water = height
+                        await state.update_one(
+                            {"_id": "tip"},
+                            {"$set": {"height": height, "updated_at": utcnow()}},
+                            upsert=True,
+                        )
+                        frontier.save_membership()
+                except Exception as e:
+                    # the high-water mark only moves on success, so nothing is skipped
+                    print("Frontier: Error following the tip:", repr(e))
+                if time.monotonic() - reported >= report_seconds:
+                    print("Frontier: Membership stats:", frontier.membership_stats())
+                    reported = time.monotonic()
+                await asyncio.sleep(poll_seconds)
+    finally:
+        frontier.save_membership(force=True)
+        frontier.close()
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+
+def populate_frontier(block_no=None):
+    """
+    Populate the frontier with seed URLs (arweave TXs)
+    by connecting to the arweave node using graphql and
+    querying for the latest block number, then
+    ingesting all the TXs in the latest 50 blocks
+    into the frontier.
+
+    """
+    return asyncio.run(backfill_latest(50, block_no))
 
 
 if __name__ == "__main__":
-    frontier = Frontier()
-    print("Frontier initialized")
-    print("Frontier test passed")
-    if len(sys.argv) > 1:
+    # frontier.py                    latest 50 blocks
+    # frontier.py <block>            50 blocks up to <block>
+    # frontier.py <min> <max>        blocks <min>..<max>
+    # frontier.py follow             keep following the chain tip
+    if len(sys.argv) > 1 and sys.argv[1] == "follow":
+        asyncio.run(follow_tip())
+    elif len(sys.argv) > 2:
+        asyncio.run(backfill(int(sys.argv[1]), int(sys.argv[2])))
+    elif len(sys.argv) > 1:
         block_no = sys.argv[1]
-        populate_frontier(frontier, block_no)
+        populate_frontier(block_no)
     else:
-        populate_frontier(frontier)
+        populate_frontier()
@@ -7,12 +7,112 @@ import json
 from dotenv import load_dotenv
 import asyncio
 import datetime
-from elasticsearch import Elasticsearch
-from frontier import Frontier
+from elasticsearch import Elasticsearch, ApiError, NotFoundError
+from frontier import AsyncFrontier
+from clients import get_elastic, close_elastic
+from cache import bump_index_version, flush_index_version
+from classifier import ENRICHMENT_VERSION, ENRICHMENT_FIELDS, enrich
+from search import mapping_fields
+import metrics
 
 client = None
 
+log = metrics.get_logger("Indexer")
+BULK_SECONDS = metrics.histogram("es_bulk_seconds", "ES _bulk request latency")
+BULK_ITEMS = metrics.counter("es_bulk_items_total", "ES bulk items by result")
+
+# searches and writes go through the alias, which points at the current versioned index
+INDEX_ALIAS = "search-artx"
+# bump whenever INDEX_SETTINGS change in a way that can't be applied in place (changed
+# field types or analyzers), then run `indexer.py --migrate`; new fields are added on startup
+MAPPING_VERSION = 1
+INDEX_SETTINGS = {
+    "settings": {
+        "number_of_shards": 1,
+        "number_of_replicas": 0,
+        "analysis": {
+            "analyzer": {
+                # text fields: folded, stemmed English
+                "default": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "asciifolding", "stop", "snowball"],
+                }
+            }
+        },
+    },
+    "mappings": {
+        # unmapped fields stay in _source but aren't indexed
+        "dynamic": False,
+        "properties": {
+            "txid": {"type": "keyword"},
+            # name/value pairs stay paired, so a query can match a value under a given name
+            "tags": {
+                "type": "nested",
+                "properties": {
+                    "name": {"type": "keyword"},
+                    "value": {
+                        "type": "text",
+                        "fields": {"raw": {"type": "keyword", "ignore_above": 256}},
+                    },
+                },
+            },
+            "content": {"type": "text"},
+            "page_title": {"type": "text"},
+            "page_description": {"type": "text"},
+            # only ever returned, never searched
+            "links": {"type": "keyword", "index": False, "doc_values": False},
+            "title": {"type": "text"},
+            "description": {"type": "text"},
+            "topics": {"type": "text", "fields": {"raw": {"type": "keyword", "ignore_above": 256}}},
+            "type": {"type": "keyword"},
+            "app_name": {"type": "keyword"},
+            "markers": {"type": "keyword"},
+            "indexed_at": {"type": "date"},
+            "enrichment_version": {"type": "integer"},
+            # last partial update, see deep_index
+            "updated_at": {"type": "date"},
+            # sha256 of the fetched body, and on duplicates the txid first crawled with it
+            "content_hash": {"type": "keyword"},
+            "canonical": {"type": "keyword"},
+            # on canonical documents: the txids, and titles/descriptions/topics, of the
+            # duplicates, which search leaves out in favour of the canonical document
+            "duplicates": {"type": "keyword"},
+            "duplicate_text": {"type": "text"},
+        },
+    },
+}
+
+
+# appends a duplicate's txid and text to its canonical document, once
+ADD_DUPLICATE_SCRIPT = """
+if (ctx._source.duplicates == null) { ctx._source.duplicates = []; }
+if (ctx._source.duplicate_text == null) { ctx._source.duplicate_text = []; }
+if (ctx._source.duplicates.contains(params.txid)) { ctx.op = 'noop'; }
+else { ctx._source.duplicates.add(params.txid); ctx._source.duplicate_text.addAll(params.text); }
+"""
+# fields add_duplicate() keeps on a canonical document, which its re-indexing must not drop
+DUPLICATE_FIELDS = ["duplicates", "duplicate_text"]
+# replaces an existing document with params.doc, except for params.kept fields
+REPLACE_KEEPING_SCRIPT = """
+def kept = [:];
+for (field in params.kept) { if (ctx._source.containsKey(field)) { kept[field] = ctx._source[field]; } }
+ctx._source.clear();
+ctx._source.putAll(params.doc);
+ctx._source.putAll(kept);
+"""
+
+
+def versioned_index_name(version=MAPPING_VERSION):
+    """
+    Name of the concrete index for a mapping version
+    """
+    return "%s-v%d" % (INDEX_ALIAS, version)
+
 def get_elastic_client():
+    """
+    Shared sync Elasticsearch client, constructing it does no network I/O
+    """
     global client
     if client is None:
         load_dotenv()
@@ -20,9 +120,6 @@ def get_elastic_client():
             "http://" + os.getenv("ELASTICSEARCH_HOST") + ":" + os.getenv("ELASTICSEARCH_PORT"),
             api_key=os.getenv("ELASTICSEARCH_API_KEY"),
         )
-        # API key should have cluster monitor rights
-        client.info()
-        print("Initialized ES client: Elasticsearch version:", client.info()["version"]["number"])
     return client
 
 
@@ -36,41 +133,20 @@ class Indexer:
         Constructor
         """
         self.client = get_elastic_client()
-        self.index_name = "search-artx"
-        # self.index_settings = {
-        #     "settings": {
-        #         "number_of_shards": 1,
-        #         "number_of_replicas": 0,
-        #         "analysis": {
-        #             "analyzer": {
-        #                 "default": {
-        #                     "type": "custom",
-        #                     "tokenizer": "standard",
-        #                     "filter": ["lowercase", "stop", "snowball"],
-        #                 }
-        #             }
-        #         },
-        #     },
-        #     "mappings": {
-        #         "properties": {
-        #             "content": {"type": "text"},
-        #             "txid": {"type": "text"},
-        #             "tags": {"type": "text"},
-                    
-        #         }
-        #     },
-        # }
-        # self.init_index()
+        self.index_name = INDEX_ALIAS
+        self.index_settings = INDEX_SETTINGS
 
     def init_index(self):
         """
         Initialize the index
         """
-        if not self.client.indices.exists(self.index_name):
+        if not self.client.indices.exists(index=self.index_name):
             self.client.indices.create(
-                index=self.index_name, body=self.index_settings
+                index=versioned_index_name(),
+                aliases={self.index_name: {"is_write_index": True}},
+                **self.index_settings,
             )
-            print("Indexer: Created index", self.index_name)
+            print("Indexer: Created index", versioned_index_name(), "as", self.index_name)
         else:
             print("Indexer: Index", self.index_name, "already exists")
 
@@ -78,156 +154,559 @@ class Indexer:
         """
         Index a document
         """
-        print("Indexer: Indexing document:", doc)
+        if metrics.sampled(log):
+            log.debug("Indexing document: %s", doc["txid"])
         self.client.index(index=self.index_name, body=doc, id=doc["txid"])
 
     def update_document(self, doc):
         """
         Update a document
         """
-        print("Indexer: Updating document:", doc)
+        if metrics.sampled(log):
+            log.debug("Updating document: %s", doc["txid"])
         self.client.update(index=self.index_name, id=doc["txid"], doc=doc)
 
-def index_lifecycle():
+
+def retryable(result):
     """
-    Index lifecycle
+    Whether a bulk item failed for a reason that goes away: back pressure or a write block
     """
-    indexer = Indexer()
-    frontier = Frontier()
-    while True:
-        print("Indexer: Index lifecycle")
-        tx = frontier.get_next_tx()
-        if tx is None:
-            print("Indexer: No transactions to index")
-            time.sleep(1)
-            continue
-        else:
-            print("Indexer: Indexing transaction:", tx["txid"])
-            indexer.index_document(tx)
+    if result["status"] == 429:
+        return True
+    return (result.get("error") or {}).get("type") == "cluster_block_exception"
 
-# expects a elasticsearch document as input, returns an updated document in tuple
-def local_index_ANS110(document):
-    # check if the document's metadata is ANS-110 compliant
+
+class BulkIndexer:
     """
-        ANS-110 compliant metadata:
-            "tags": {
-                "Title"*: str,
-                "Type"*: str,
-                "Description": str,
-                "Topic": str
-            }
+    Buffered writer for the ES _bulk API
+
+    Actions are buffered and sent as one _bulk request once the buffer holds
+    max_docs documents or max_bytes of source, or flush_seconds after the first
+    buffered action. At most max_in_flight bulk requests are outstanding; adding
+    to a full pipeline waits, which pushes back on the producer. Items rejected
+    with 429, or by a write block (an index migration in progress), are retried with
+    exponential backoff, other item errors are final.
+
+    index()/update() return a future that resolves to True once ES acknowledged
+    the item, False if ES rejected it (a mapping error, a missing document...), which
+    retrying won't change, or None if it wasn't written (retries exhausted, request
+    failed). Updates retry version conflicts server side, retry_on_conflict times.
     """
-    metadata = document['_source']['tags']
-    # check for required fields
-    title = None
-    type = None
-    description = None
-    topics = []
-    for tag in metadata:
-        if tag['name'] == 'Title':
-            title = tag['value']
-        elif tag['name'] == 'Type':
-            type = tag['value']
-        elif tag['name'] == 'Description':
-            description = tag['value']
-        elif "Topic:" in tag['name']:
-            topics.append(tag['value'])
-    if title is None or type is None:
-        print("Indexer: Document is not ANS-110 compliant")
-        return (False, document)
-    # update the document
-    document['_source']['title'] = title
-    document['_source']['type'] = type
-    document['_source']['description'] = description
-    document['_source']['topics'] = topics
-    if 'markers' not in document['_source']:
-        document['_source']['markers'] = ["ANS-110"]
-    else:
-        if "ANS-110" not in document['_source']['markers']:
-            document['_source']['markers'].append("ANS-110")
-    # # remove the old tags
-    # del document['_source']['tags']
-    print("Indexer: Document is ANS-110 compliant")
-    print(json.dumps(document, indent=4))
-    # sys.exit()
-    return (True, document)
-
-def index_Misc(document):
-    """
-        Index: NFTs and UDLs
-        Defining NFTs as docs with ANS-110 mdata + ContentType: "image/*"
-        UDLs as docs with ANS-110 mdata + tag: "License"
-    """
-    metadata = document['_source']['tags']
-    # check for required fields
-    if 'ANS-110' in document['_source']['markers']:
-        for tag in metadata:
-            if tag['name'] == 'ContentType':
-                if "image" in tag['value']:
-                    # It's an NFT!
-                    document['_source']['markers'].append("NFT")
-            if tag['name'] == 'License':
-                # It's a UDL!
-                document['_source']['markers'].append("UDL")
-                
-
-
-def deep_index():
-    indexer = Indexer()
-    while True:
-        # get all documents from elasticsearch, in batches of 10,000, using the scroll API
-        documents = indexer.client.search(
-            index=indexer.index_name,
-            scroll="2m",
-            size=10000,
-            body={"query": {"match_all": {}}},
-        )
-        # get the scroll ID
-        sid = documents["_scroll_id"]
-        # get the first batch of documents
-        hits = documents["hits"]["hits"]
-        # while there is a batch of documents
-        while len(hits):
-            # for each document
-            for hit in hits:
-                # get the document ID
-                txid = hit["_id"]
-                # run local_index_ANS110
-                (is_ANS110, document) = local_index_ANS110(hit)
-                index_NFT(document)
-                # update the document
-                if is_ANS110:
-                    indexer.update_document(document['_source'])
-            # get the next batch of documents
-            documents = indexer.client.scroll(scroll_id=sid, scroll="2m")
-            # get the scroll ID
-            sid = documents["_scroll_id"]
-            # get the next batch of documents
-            hits = documents["hits"]["hits"]
 
+    def __init__(self, client, index_name, max_docs=None, max_bytes=None,
+                 flush_seconds=None, max_in_flight=None, max_retries=None, on_written=None):
+        """
+        Constructor
+        """
+        load_dotenv()
+        self.client = client
+        self.index_name = index_name
+        self.max_docs = int(max_docs or os.getenv("INDEXER_BULK_DOCS", "500"))
+        self.max_bytes = int(max_bytes or os.getenv("INDEXER_BULK_BYTES", str(5 * 1024 * 1024)))
+        self.flush_seconds = float(flush_seconds or os.getenv("INDEXER_FLUSH_SECONDS", "1"))
+        self.max_in_flight = int(max_in_flight or os.getenv("INDEXER_BULK_IN_FLIGHT", "4"))
+        self.max_retries = int(max_retries or os.getenv("INDEXER_BULK_RETRIES", "5"))
+        self.retry_on_conflict = int(os.getenv("INDEXER_RETRY_ON_CONFLICT", "3"))
+        # buffered (action, source, future) items
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.sending = set()
+        self.timer = None
+        self.stats = {"bulks": 0, "indexed": 0, "retried": 0, "failed": 0}
+        # awaited once a send() wrote documents, after its items are resolved
+        self.on_written = on_written
+
+    async def index(self, doc, id):
+        """
+        Buffer a document for indexing
+        """
+        return await self.add({"index": {"_index": self.index_name, "_id": id}}, doc)
 
+    async def update(self, doc, id):
+        """
+        Buffer a partial document update
+        """
+        return await self.add(self.update_action(id), {"doc": doc})
 
+    async def script(self, source, params, id, upsert=None):
+        """
+        Buffer a scripted (painless) update, indexing `upsert` if the document is missing
+        """
+        body = {"script": {"source": source, "lang": "painless", "params": params}}
+        if upsert is not None:
+            body["upsert"] = upsert
+        return await self.add(self.update_action(id), body)
 
+    def update_action(self, id):
+        return {"update": {"_index": self.index_name, "_id": id,
+                           "retry_on_conflict": self.retry_on_conflict}}
 
+    async def add(self, action, source):
+        """
+        Buffer a bulk action, flushing if the buffer is full
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.buffer.append((action, source, future))
+        self.buffer_bytes += len(json.dumps(source, default=str))
+        if len(self.buffer) >= self.max_docs or self.buffer_bytes >= self.max_bytes:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+        return future
+
+    async def flush_later(self):
+        """
+        Flush whatever is buffered after flush_seconds
+        """
+        await asyncio.sleep(self.flush_seconds)
+        self.timer = None
+        await self.flush()
 
+    async def flush(self):
+        """
+        Send the buffer as one bulk request, waiting while max_in_flight are outstanding
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if len(self.buffer) == 0:
+            return
+        items = self.buffer
+        self.buffer = []
+        self.buffer_bytes = 0
+        # outstanding from here on, so close() waits for it even if it's still queued
+        task = asyncio.create_task(self.send(items))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+        while len(self.sending) > self.max_in_flight:
+            await asyncio.wait(set(self.sending), return_when=asyncio.FIRST_COMPLETED)
+
+    async def send(self, items):
+        """
+        Send bulk items, retrying the ones rejected with 429
+        """
+        written = False
+        await self.slots.acquire()
+        try:
+            for attempt in range(self.max_retries + 1):
+                if attempt > 0:
+                    self.stats["retried"] += len(items)
+                    BULK_ITEMS.inc(len(items), result="retried")
+                    await asyncio.sleep(min(0.5 * 2 ** (attempt - 1), 30))
+                operations = []
+                for action, source, _ in items:
+                    operations.append(action)
+                    operations.append(source)
+                try:
+                    with BULK_SECONDS.time():
+                        response = await self.client.bulk(operations=operations)
+                except ApiError as e:
+                    # the whole request was rejected, retry all of it
+                    if e.meta.status == 429:
+                        continue
+                    raise
+                self.stats["bulks"] += 1
+                retry = []
+                for item, (action, source, future) in zip(response["items"], items):
+                    result = next(iter(item.values()))
+                    if retryable(result):
+                        retry.append((action, source, future))
+                    elif result["status"] >= 300:
+                        log.warning("Bulk item failed: %s %s", result["_id"], result.get("error"))
+                        self.stats["failed"] += 1
+                        BULK_ITEMS.inc(result="failed")
+                        future.set_result(False)
+                    else:
+                        self.stats["indexed"] += 1
+                        BULK_ITEMS.inc(result="indexed")
+                        future.set_result(True)
+                        written = True
+                if len(retry) == 0:
+                    return
+                items = retry
+            log.warning("Giving up on %d bulk items after %d retries", len(items), self.max_retries)
+            self.stats["failed"] += len(items)
+            BULK_ITEMS.inc(len(items), result="failed")
+            for _, _, future in items:
+                future.set_result(None)
+        except Exception as e:
+            log.warning("Bulk request failed: %r", e)
+            pending = [future for _, _, future in items if not future.done()]
+            self.stats["failed"] += len(pending)
+            BULK_ITEMS.inc(len(pending), result="failed")
+            for future in pending:
+                future.set_result(None)
+        finally:
+            self.slots.release()
+        # once per send, its failure doesn't touch the items' results
+        if written and self.on_written is not None:
+            try:
+                await self.on_written()
+            except Exception as e:
+                log.warning("After-write callback failed: %r", e)
+
+    async def close(self):
+        """
+        Flush the buffer and wait for all outstanding bulk requests
+        """
+        await self.flush()
+        if self.sending:
+            await asyncio.gather(*self.sending)
 
-    # number of documents
-    num_docs = documents["hits"]["total"]["value"]
-    print(f"Found {num_docs} documents")
 
+class AsyncIndexer:
+    """
+    Asyncio indexer, writes through a BulkIndexer
+    """
 
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.client = get_elastic()
+        self.index_name = INDEX_ALIAS
+        # cached search results are invalidated whenever documents are written
+        self.bulk = BulkIndexer(self.client, self.index_name, on_written=bump_index_version)
 
+    async def init_index(self):
+        """
+        Create the index if it doesn't exist yet
+        """
+        await ensure_index(self.client)
 
-def main():
-    global client
-    load_dotenv()
+    async def index_document(self, doc):
+        """
+        Index a document
 
-    # client = get_elastic_client()
+        Returns a future that resolves once the document is acknowledged
+        """
+        if "content_hash" in doc and "canonical" not in doc:
+            # a canonical document crawled again keeps the duplicates recorded on it
+            return await self.bulk.script(REPLACE_KEEPING_SCRIPT,
+                                          {"doc": doc, "kept": DUPLICATE_FIELDS},
+                                          doc["txid"], upsert=doc)
+        return await self.bulk.index(doc, doc["txid"])
+
+    async def update_document(self, doc):
+        """
+        Update a document
+        """
+        return await self.bulk.update(doc, doc["txid"])
 
-    indexer = Indexer()
-    frontier = Frontier()
+    async def add_duplicate(self, doc):
+        """
+        Record a duplicate document on its canonical document, so its text finds it
 
-    deep_index()
+        Returns a future like index_document
+        """
+        text = [doc[f] for f in ("title", "description") if doc.get(f)] + doc.get("topics", [])
+        return await self.bulk.script(ADD_DUPLICATE_SCRIPT, {"txid": doc["txid"], "text": text},
+                                      doc["canonical"])
+
+    async def close(self):
+        """
+        Flush pending writes and close the client connection pool
+        """
+        await self.bulk.close()
+        await flush_index_version()
+        await close_elastic()
+
+async def alias_indices(client):
+    """
+    Concrete indices behind INDEX_ALIAS, or None if INDEX_ALIAS is a plain index
+    """
+    try:
+        return sorted(await client.indices.get_alias(name=INDEX_ALIAS))
+    except NotFoundError:
+        if await client.indices.exists(index=INDEX_ALIAS):
+            return None
+        return []
+
+
+async def ensure_index(client):
+    """
+    Create the current versioned index behind INDEX_ALIAS, unless the alias exists
+
+    Warns if the alias points at an index of an older mapping version, or if the index
+    predates the alias (dynamic mapping); both are upgraded by migrate_index().
+    Otherwise the current mapping is put on the index, which adds new fields.
+    """
+    indices = await alias_indices(client)
+    if indices == []:
+        try:
+            await client.indices.create(
+                index=versioned_index_name(),
+                aliases={INDEX_ALIAS: {"is_write_index": True}},
+                **INDEX_SETTINGS,
+            )
+            print("Indexer: Created index", versioned_index_name(), "as", INDEX_ALIAS)
+        except ApiError as e:
+            # another process created it first
+            if e.meta.status != 400:
+                raise
+    elif indices is None or versioned_index_name() not in indices:
+        print("Indexer: Index", INDEX_ALIAS, "is not on mapping version", MAPPING_VERSION,
+              "- run `indexer.py --migrate`")
+    else:
+        # fields added since the index was created
+        await client.indices.put_mapping(
+            index=versioned_index_name(), **INDEX_SETTINGS["mappings"]
+        )
+
+
+async def wait_for_task(client, task_id, poll_seconds=5):
+    """
+    Wait for a background ES task, returns its response
+    """
+    while True:
+        task = await client.tasks.get(task_id=task_id)
+        if task["completed"]:
+            if "error" in task:
+                raise RuntimeError("Task %s failed: %s" % (task_id, task["error"]))
+            return task["response"]
+        status = task["task"]["status"]
+        print("Indexer: Reindexed", status["created"] + status["updated"], "of", status["total"])
+        await asyncio.sleep(poll_seconds)
+
+
+async def reindex(client, source, dest, query=None, op_type="create"):
+    """
+    Copy documents from source into dest in the background
+
+    With op_type "create" documents dest already has are skipped, with "index" the
+    source's copy replaces them.
+    """
+    body = {"index": source}
+    if query is not None:
+        body["query"] = query
+    task = await client.reindex(
+        source=body,
+        dest={"index": dest, "op_type": op_type},
+        conflicts="proceed",
+        slices="auto",
+        wait_for_completion=False,
+    )
+    response = await wait_for_task(client, task["task"])
+    print("Indexer: Reindexed", source, "->", dest + ":", response["created"], "created,",
+          response["updated"], "updated,", response["version_conflicts"], "already there")
+    return response
+
+
+def changed_since(when):
+    """
+    Query for documents indexed or updated since `when`, with a minute of slack
+    """
+    since = when - datetime.timedelta(minutes=1)
+    return {
+        "bool": {
+            "should": [
+                {"range": {"indexed_at": {"gte": since}}},
+                {"range": {"updated_at": {"gte": since}}},
+            ]
+        }
+    }
+
+
+async def migrate_index(delete_old=False):
+    """
+    Move INDEX_ALIAS onto a new index with the current INDEX_SETTINGS, without downtime
+
+    - create the new versioned index
+    - copy the documents of the old index(es) into it, while the alias keeps serving
+      searches and taking writes on the old index
+    - copy again what was indexed or updated during the copy, replacing stale copies
+    - block writes to the old index, copy what changed during the second pass, and
+      swap the alias onto the new index in one atomic update_aliases call
+    Searches are served throughout. Writes rejected during the final pass are retried:
+    bulk items by the BulkIndexer, crawled TXs once their lease expires, and
+    deep_index pages by deep_index.
+    A plain (pre-alias) index named INDEX_ALIAS is migrated the same way, and deleted
+    in the swap, since an alias can't share its name with an index.
+    """
+    load_dotenv()
+    client = get_elastic()
+    try:
+        indices = await alias_indices(client)
+        new_index = versioned_index_name()
+        if indices == []:
+            await ensure_index(client)
+            return
+        old_indices = [INDEX_ALIAS] if indices is None else indices
+        if old_indices == [new_index]:
+            print("Indexer: Index", INDEX_ALIAS, "is already on", new_index)
+            return
+        old_indices = [index for index in old_indices if index != new_index]
+        if not await client.indices.exists(index=new_index):
+            await client.indices.create(index=new_index, **INDEX_SETTINGS)
+            print("Indexer: Created index", new_index)
+        started = datetime.datetime.now(datetime.timezone.utc)
+        for index in old_indices:
+            await reindex(client, index, new_index)
+        # documents indexed or updated while they were being copied
+        caught_up = datetime.datetime.now(datetime.timezone.utc)
+        for index in old_indices:
+            await reindex(client, index, new_index, changed_since(started), "index")
+        # nothing can change on the old index now, so the last pass leaves no gap
+        await client.indices.put_settings(index=old_indices, settings={"index.blocks.write": True})
+        try:
+            for index in old_indices:
+                await reindex(client, index, new_index, changed_since(caught_up), "index")
+            await client.indices.refresh(index=new_index)
+            actions = [{"add": {"index": new_index, "alias": INDEX_ALIAS, "is_write_index": True}}]
+            if indices is None:
+                actions.append({"remove_index": {"index": INDEX_ALIAS}})
+            else:
+                actions += [{"remove": {"index": index, "alias": INDEX_ALIAS}}
+                            for index in old_indices]
+            await client.indices.update_aliases(actions=actions)
+        except Exception:
+            # the swap didn't happen, the old index keeps taking writes
+            await client.indices.put_settings(index=old_indices,
+                                              settings={"index.blocks.write": None})
+            raise
+        print("Indexer: Alias", INDEX_ALIAS, "now points at", new_index)
+        await bump_index_version()
+        if indices is None:
+            return
+        for index in old_indices:
+            if delete_old:
+                await client.indices.delete(index=index)
+                print("Indexer: Deleted index", index)
+            else:
+                await client.indices.put_settings(index=index, settings={"index.blocks.write": None})
+    finally:
+        await close_elastic()
+
+
+CHECKPOINT_ID = "deep_index"
+
+
+async def deep_index(reset=False):
+    """
+    Incrementally enrich indexed documents
+
+    Documents are classified by the crawler before they are first indexed, so this
+    only has work to do after the classifiers change (ENRICHMENT_VERSION is bumped).
+
+    Walks documents that don't carry the current ENRICHMENT_VERSION in indexed_at
+    order with search_after, and persists the position in the "checkpoints" MongoDB
+    collection, so each document is visited once per enrichment version. Documents
+    are only written when the enrichment output differs from what is indexed. A page
+    is retried until its updates are written, except those ES rejects, which are
+    logged and skipped.
+    Once caught up it polls for newly indexed documents.
+    """
+    load_dotenv()
+    indexer = AsyncIndexer()
+    checkpoints = AsyncFrontier().db["checkpoints"]
+    batch_size = int(os.getenv("DEEP_INDEX_BATCH", "1000"))
+    poll_seconds = int(os.getenv("DEEP_INDEX_POLL_SECONDS", "30"))
+    # documents younger than this may not be searchable yet, leave them for the next pass
+    lag_seconds = int(os.getenv("DEEP_INDEX_LAG_SECONDS", "60"))
+    if reset:
+        await checkpoints.delete_one({"_id": CHECKPOINT_ID})
+    # a checkpoint from an older enrichment version starts over from the beginning
+    checkpoint = await checkpoints.find_one(
+        {"_id": CHECKPOINT_ID, "version": ENRICHMENT_VERSION}
+    )
+    search_after = checkpoint["search_after"] if checkpoint else None
+    scanned = 0
+    updated = 0
+    failed = 0
+    rejected_total = 0
+    # txids on the current page whose update ES rejected, not sent again when it's retried
+    rejected = set()
+    try:
+        while True:
+            # the txid field to sort on depends on the mapping, which a migration changes
+            fields = mapping_fields(await indexer.client.indices.get_mapping(index=indexer.index_name))
+            body = {
+                "query": {
+                    "bool": {
+                        "must_not": [{"term": {"enrichment_version": ENRICHMENT_VERSION}}],
+                        "filter": [
+                            {
+                                "bool": {
+                                    "should": [
+                                        {"range": {"indexed_at": {"lt": "now-%ds" % lag_seconds}}},
+                                        {"bool": {"must_not": {"exists": {"field": "indexed_at"}}}},
+                                    ]
+                                }
+                            }
+                        ],
+                    }
+                },
+                "sort": [
+                    {"indexed_at": {"order": "asc", "missing": "_first"}},
+                    {fields["txid"]: {"order": "asc", "unmapped_type": "keyword"}},
+                ],
+                "_source": ["txid", "tags"] + ENRICHMENT_FIELDS,
+                "size": batch_size,
+            }
+            if search_after is not None:
+                body["search_after"] = search_after
+            documents = await indexer.client.search(index=indexer.index_name, body=body)
+            hits = documents["hits"]["hits"]
+            if len(hits) == 0:
+                print("Indexer: Enrichment caught up:", scanned, "scanned,", updated, "updated,",
+                      failed, "failed updates retried,", rejected_total, "rejected")
+                await asyncio.sleep(poll_seconds)
+                continue
+            pending = []
+            for hit in hits:
+                source = hit["_source"]
+                fields = enrich(source)
+                changed = {f: v for f, v in fields.items() if source.get(f) != v}
+                if changed and source["txid"] not in rejected:
+                    changed["txid"] = source["txid"]
+                    changed["enrichment_version"] = ENRICHMENT_VERSION
+                    changed["updated_at"] = datetime.datetime.now(datetime.timezone.utc)
+                    pending.append((source["txid"], await indexer.update_document(changed)))
+            # only move the checkpoint past updates that made it into the index
+            if pending:
+                results = await asyncio.gather(*(future for _, future in pending))
+                updated += results.count(True)
+                skipped = [txid for (txid, _), result in zip(pending, results) if result is False]
+                if skipped:
+                    # ES rejected them, retrying won't help: move past them
+                    rejected.update(skipped)
+                    rejected_total += len(skipped)
+                    print("Indexer: Enrichment updates rejected, skipping:", skipped)
+                unwritten = results.count(None)
+                if unwritten:
+                    # retry the page: the documents that did get updated now carry
+                    # ENRICHMENT_VERSION, so the same query only returns the rest again
+                    failed += unwritten
+                    print("Indexer: Enrichment updates failed:", unwritten, "of", len(results),
+                          "- retrying the page,", failed, "failed so far")
+                    await asyncio.sleep(poll_seconds)
+                    continue
+            scanned += len(hits)
+            rejected.clear()
+            search_after = hits[-1]["sort"]
+            await checkpoints.update_one(
+                {"_id": CHECKPOINT_ID},
+                {
+                    "$set": {
+                        "version": ENRICHMENT_VERSION,
+                        "search_after": search_after,
+                        "updated_at": datetime.datetime.now(datetime.timezone.utc),
+                    }
+                },
+                upsert=True,
+            )
+    finally:
+        # flush buffered updates on shutdown
+        await indexer.close()
+
+
+def main():
+    load_dotenv()
+    if "--migrate" in sys.argv:
+        asyncio.run(migrate_index(delete_old="--delete-old" in sys.argv))
+    else:
+        asyncio.run(deep_index(reset="--reset" in sys.argv))
 
 
 
@@ -8,15 +8,77 @@ from dotenv import load_dotenv
 import asyncio
 import uvicorn
 import strawberry
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+from typing import List, Optional
 from strawberry.asgi import GraphQL
-from search import SearchClient
+from search import get_search_client, hit_cursor, hit_snippets, decode_cursor, MAX_SIZE
 from model import schema
+import clients
+import metrics
 
 
 app = FastAPI()
 app.include_router(schema.router, prefix="/graphql")
-search_client = SearchClient()
+search_client = get_search_client()
+
+log = metrics.get_logger("API")
+REQUEST_SECONDS = metrics.histogram("api_request_seconds", "API request latency, by route")
+
+
+def cache_gauges():
+    gauges = []
+    for name, cache in (("search", search_client.cache), ("facets", search_client.facet_cache),
+                        ("documents", search_client.document_cache)):
+        gauges.append(("search_cache_bytes", {"cache": name}, cache.bytes))
+        for stat, value in cache.stats.items():
+            gauges.append(("search_cache_" + stat, {"cache": name}, value))
+    return gauges
+
+
+metrics.add_collector(cache_gauges)
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    # by route template, not raw path, to keep the label set small
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        route=route.path if route is not None else "other",
+        status=response.status_code,
+    )
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    '''
+    Metrics in the Prometheus text format
+    '''
+    return metrics.render()
+
+
+@app.on_event("startup")
+async def startup():
+    # reports, but doesn't fail on, backends that are down
+    await clients.check()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await clients.close()
+
+
+@app.get("/health")
+async def health():
+    '''
+    Backend connectivity
+    '''
+    status = await clients.check()
+    return {name: not isinstance(result, Exception) for name, result in status.items()}
 
 
 @app.get("/")
@@ -26,11 +88,41 @@ async def root():
     '''
     return {"message": "ExplorAR API", "version": "0.0.1"}
 
+def search_result(hit):
+    '''
+    Search result of an ES hit
+    '''
+    doc = hit['_source']
+    return {
+        "txid": doc['txid'],
+        "title": doc.get('title') or doc.get('page_title') or 'Title unavailable',
+        "description": doc.get('description') or doc.get('page_description') or 'Description unavailable',
+        "type": doc['type'] if 'type' in doc else 'Type unavailable',
+        "tags": doc['tags'] if 'tags' in doc else [],
+        "markers": doc['markers'] if 'markers' in doc else [],
+        "snippets": hit_snippets(hit),
+        "cursor": hit_cursor(hit),
+        "canonical": doc.get('canonical'),
+        "duplicates": doc.get('duplicates', []),
+    }
+
+
 @app.get("/search")
-async def search(query: str):
+async def search(
+    query: str,
+    size: int = 10,
+    offset: int = Query(0, alias="from"),
+    cursor: Optional[str] = None,
+    highlight: bool = False,
+    markers: Optional[List[str]] = Query(None),
+    type: Optional[str] = None,
+):
     '''
     Search
 
+    Paged with size/from, or with the cursor of the last result of the previous page.
+    Filtered to results with any of `markers` and/or of `type`.
+
     Retuns a JSON object with the search results in format:
         txid: str
         title: str
@@ -38,27 +130,63 @@ async def search(query: str):
         type: str
         tags: List[Tag]
         markers: List[str]
+        snippets: List[str] (highlighted content, if highlight is set)
+        cursor: str
+        canonical: str (txid of the TX first seen with the same content, if a duplicate)
+        duplicates: List[str] (txids of the TXs with the same content, if canonical)
     '''
-    print(f"Searching for {query}")
+    if metrics.sampled(log):
+        log.debug("Searching for %s", query)
     # res = search_client.search(query)
     # print pretty
+    try:
+        search_after = decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     res = []
-    for hit in search_client.search(query):
-        doc = hit['_source']
-        print(hit)
-        res.append({
-            "txid": doc['txid'],
-            "title": doc['title'] if 'title' in doc else 'Title unavailable',
-            "description": doc['description'] if 'description' in doc else 'Description unavailable',
-            "type": doc['type'] if 'type' in doc else 'Type unavailable',
-            "tags": doc['tags'] if 'tags' in doc else [],
-            "markers": doc['markers'] if 'markers' in doc else []
-        })
+    hits = await search_client.search(
+        query, size, offset, search_after, highlight, markers, type
+    )
+    for hit in hits:
+        res.append(search_result(hit))
     # return in JSON format
-    print(res)
     return json.dumps(res)
 
 
+@app.get("/get")
+async def get(txid: List[str] = Query(...)):
+    '''
+    Get documents by txid
+
+    Retuns a JSON list with the result (as /search, without snippets and cursor) of
+    each txid, or null where there is no document for it.
+    '''
+    hits = await search_client.get_many(txid[:MAX_SIZE])
+    return json.dumps([search_result(hit) if hit is not None else None for hit in hits])
+
+
+@app.get("/facets")
+async def facets(
+    query: str,
+    size: int = 10,
+    markers: Optional[List[str]] = Query(None),
+    type: Optional[str] = None,
+    facet_size: int = 10,
+):
+    '''
+    Search with facet counts
+
+    Retuns a JSON object with the first `size` search results (as /search) and, per
+    facet (markers, types, topics, apps), the top `facet_size` values with their
+    document counts for the query. `markers`/`type` narrow the results, not the counts.
+    '''
+    res = await search_client.facets(query, size, markers, type, facet_size)
+    return json.dumps({
+        "results": [search_result(hit) for hit in res["hits"]],
+        "facets": res["facets"],
+    })
+
+
 if __name__ == "__main__":
     load_dotenv()
     uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
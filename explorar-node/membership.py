@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+membership.py
+
+In-process membership layer for txids the frontier already knows, so overlapping
+backfills and tip re-scans don't have to ask MongoDB about every TX again.
+
+- LRUSet: exact, bounded set of recently seen txids
+- BloomFilter: compact probabilistic set of every known txid, no false negatives
+- KnownTxids: both of the above, seeded from the artx collection and persisted to
+  disk together with the _id it was seeded up to, so a restart only scans the
+  documents added since the last save
+"""
+
+import os
+import json
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from bson import ObjectId
+
+
+class LRUSet:
+    """
+    Set that forgets its least recently used keys beyond `size`
+    """
+
+    def __init__(self, size):
+        """
+        Constructor
+        """
+        self.size = size
+        self.keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            return True
+        return False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        self.keys[key] = None
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+
+
+class BloomFilter:
+    """
+    Bloom filter over strings, sized for `capacity` keys at `error_rate` false positives
+    """
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        """
+        Constructor
+        """
+        self.capacity = int(capacity)
+        self.error_rate = float(error_rate)
+        self.size = max(8, int(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def positions(self, key):
+        # double hashing: k positions from the two halves of one 128 bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        # only counts keys that set at least one new bit, so re-adding is free
+        bits = self.bits
+        added = False
+        for p in self.positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def save(self, path, meta=None):
+        """
+        Write the filter to `path`: a JSON header line followed by the bit array
+        """
+        header = {"capacity": self.capacity, "error_rate": self.error_rate,
+                  "count": self.count, "meta": meta or {}}
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a filter written by save(), returns (filter, meta)
+        """
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            bits = bytearray(f.read())
+        bloom = cls(header["capacity"], header["error_rate"], bits, header["count"])
+        if len(bits) != (bloom.size + 7) // 8:
+            raise ValueError("Bloom filter file %s is truncated" % path)
+        return (bloom, header["meta"])
+
+
+class KnownTxids:
+    """
+    Membership of txids in the frontier collection
+
+    split() sorts txids into known (recently seen, exact), new (not in the Bloom
+    filter, exact) and maybe (in the Bloom filter only, which can be a false positive).
+    """
+
+    def __init__(self, capacity=None, error_rate=None, lru_size=None, path=None):
+        """
+        Constructor
+        """
+        self.capacity = int(capacity or os.getenv("FRONTIER_BLOOM_CAPACITY", "20000000"))
+        self.error_rate = float(error_rate or os.getenv("FRONTIER_BLOOM_ERROR_RATE", "0.001"))
+        self.path = path or os.getenv("FRONTIER_BLOOM_PATH", "frontier.bloom")
+        self.save_seconds = float(os.getenv("FRONTIER_BLOOM_SAVE_SECONDS", "300"))
+        self.recent = LRUSet(int(lru_size or os.getenv("FRONTIER_LRU_SIZE", "100000")))
+        self.bloom = BloomFilter(self.capacity, self.error_rate)
+        # _id of the newest frontier document the filter has seen
+        self.seeded_until = None
+        self.saved_at = time.monotonic()
+        self.stats = {"lru_hits": 0, "bloom_negatives": 0, "bloom_positives": 0,
+                      "false_positives": 0}
+
+    def split(self, txids):
+        """
+        Split txids into (known, new, maybe) lists
+        """
+        known = []
+        new = []
+        maybe = []
+        for txid in txids:
+            if txid in self.recent:
+                known.append(txid)
+            elif txid not in self.bloom:
+                new.append(txid)
+            else:
+                maybe.append(txid)
+        self.stats["lru_hits"] += len(known)
+        self.stats["bloom_negatives"] += len(new)
+        self.stats["bloom_positives"] += len(maybe)
+        return (known, new, maybe)
+
+    def add(self, txids):
+        """
+        Record txids as known
+        """
+        for txid in txids:
+            if txid not in self.recent:
+                self.recent.add(txid)
+                self.bloom.add(txid)
+
+    async def seed(self, collection):
+        """
+        Load the saved filter, then add the documents inserted since it was saved
+        """
+        if os.path.exists(self.path):
+            try:
+                (bloom, meta) = BloomFilter.load(self.path)
+                if bloom.capacity == self.capacity and bloom.error_rate == self.error_rate:
+                    self.bloom = bloom
+                    self.seeded_until = meta.get("seeded_until")
+                else:
+                    print("Frontier: Bloom filter parameters changed, reseeding")
+            except (OSError, ValueError) as e:
+                print("Frontier: Could not load Bloom filter:", e)
+        query = {}
+        if self.seeded_until is not None:
+            query["_id"] = {"$gt": ObjectId(self.seeded_until)}
+        seeded = 0
+        last_id = None
+        async for doc in collection.find(query, {"txid": 1}, sort=[("_id", 1)]):
+            self.bloom.add(doc["txid"])
+            last_id = doc["_id"]
+            seeded += 1
+        if last_id is not None:
+            self.seeded_until = str(last_id)
+        print("Frontier: Bloom filter seeded with", seeded, "new txids,", self.bloom.count, "total")
+        if self.bloom.count > self.capacity:
+            print("Frontier: Bloom filter is over capacity, raise FRONTIER_BLOOM_CAPACITY")
+
+    def report(self):
+        """
+        Hit and false positive counts, with the sizes of the LRU and the Bloom filter
+        """
+        return dict(self.stats, lru_size=len(self.recent), bloom_count=self.bloom.count,
+                    bloom_capacity=self.capacity)
+
+    def save(self):
+        """
+        Persist the Bloom filter to disk
+        """
+        self.bloom.save(self.path, {"seeded_until": self.seeded_until})
+        self.saved_at = time.monotonic()
+
+    def maybe_save(self):
+        """
+        Persist the Bloom filter if it hasn't been saved for save_seconds
+        """
+        if time.monotonic() - self.saved_at >= self.save_seconds:
+            self.save()
+            return True
+        return False
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+metrics.py
+
+Lightweight in-process metrics and logging for the explorar-node services.
+
+- Counter and Histogram: cheap to update (a dict lookup and an add), with optional
+  labels; created through counter()/histogram(), which register them by name
+- collectors: callbacks that report gauges (queue depths, cache sizes...) at scrape time
+- render(): all metrics in the Prometheus text exposition format
+- serve(port): a minimal HTTP scrape endpoint for processes without a web server
+  (the crawler); the API serves render() on its /metrics route
+
+Logging goes through the standard logging module at LOG_LEVEL (default INFO).
+Per-document messages are logged at DEBUG and sampled with sampled(), so turning
+them on at volume costs a fraction of a print per document.
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = {}
+collectors = []
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key):
+    if not key:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in key)
+
+
+class Counter:
+    """
+    Monotonic counter
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        """
+        Constructor
+        """
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield (self.name, key, value)
+
+
+class Histogram:
+    """
+    Histogram of observations in fixed buckets, with their count and sum
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        """
+        Constructor
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # label key -> [per bucket counts..., count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of the with block, in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + "_bucket", key + (("le", repr(float(bound))),), cumulative)
+            yield (self.name + "_bucket", key + (("le", "+Inf"),), counts[-2])
+            yield (self.name + "_count", key, counts[-2])
+            yield (self.name + "_sum", key, counts[-1])
+
+
+def counter(name, help):
+    """
+    Get or register a counter
+    """
+    if name not in registry:
+        registry[name] = Counter(name, help)
+    return registry[name]
+
+
+def histogram(name, help, buckets=LATENCY_BUCKETS):
+    """
+    Get or register a histogram
+    """
+    if name not in registry:
+        registry[name] = Histogram(name, help, buckets)
+    return registry[name]
+
+
+def add_collector(collect):
+    """
+    Register a callback returning [(name, labels dict, value)] gauges at scrape time
+    """
+    collectors.append(collect)
+
+
+def render():
+    """
+    All metrics in the Prometheus text format
+    """
+    lines = []
+    for metric in registry.values():
+        lines.append("# HELP %s %s" % (metric.name, metric.help))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for (name, key, value) in metric.samples():
+            lines.append("%s%s %s" % (name, format_labels(key), value))
+    typed = set()
+    for collect in collectors:
+        try:
+            gauges = collect()
+        except Exception as e:
+            get_logger("Metrics").warning("Collector failed: %r", e)
+            continue
+        for (name, labels, value) in gauges:
+            if name not in typed:
+                lines.append("# TYPE %s gauge" % name)
+                typed.add(name)
+            lines.append("%s%s %s" % (name, format_labels(label_key(labels)), value))
+    return "\n".join(lines) + "\n"
+
+
+async def handle_scrape(reader, writer):
+    try:
+        # the request line and headers, any path gets the metrics
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = render().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(port, host="0.0.0.0"):
+    """
+    Serve render() over HTTP on port, returns the asyncio server
+    """
+    server = await asyncio.start_server(handle_scrape, host, port)
+    get_logger("Metrics").info("Serving metrics on %s:%d", host, port)
+    return server
+
+
+configured = False
+log_sample_rate = 0.01
+
+
+def get_logger(name):
+    """
+    Logger for a module, the first call configures logging from LOG_LEVEL and LOG_SAMPLE_RATE
+    """
+    global configured, log_sample_rate
+    if not configured:
+        load_dotenv()
+        logging.basicConfig(
+            level=os.getenv("LOG_LEVEL", "INFO").upper(),
+            format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        )
+        log_sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+        configured = True
+    return logging.getLogger(name)
+
+
+def sampled(logger):
+    """
+    Whether to log a per-document DEBUG message: DEBUG is on and the sample hits
+    """
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < log_sample_rate
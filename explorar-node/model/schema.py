@@ -3,11 +3,16 @@
 import strawberry
 from strawberry.types import Info
 from typing import List, Optional
-from search import SearchClient
+from search import get_search_client, hit_cursor, hit_snippets, decode_cursor
 from strawberry.fastapi import GraphQLRouter
+from strawberry.dataloader import DataLoader
+from graphql import GraphQLError
 import json
+import metrics
 
-search_client = SearchClient()
+log = metrics.get_logger("GraphQL")
+
+search_client = get_search_client()
 
 @strawberry.type
 class Tag:
@@ -28,6 +33,61 @@ class SearchResult:
     type: str
     tags: List[Tag]
     markers: List[str]
+    # highlighted content snippets, when searching with highlight
+    snippets: List[str] = strawberry.field(default_factory=list)
+    # pass as `cursor` to get the results after this one
+    cursor: Optional[str] = None
+    # txid of the TX first crawled with the same content, for duplicates
+    canonical: Optional[str] = None
+    # txids of the TXs with the same content, left out of search
+    duplicates: List[str] = strawberry.field(default_factory=list)
+
+@strawberry.type
+class FacetBucket:
+    '''
+    Facet value and the number of matching documents
+    '''
+    value: str
+    count: int
+
+@strawberry.type
+class Facets:
+    '''
+    Facet counts by markers, type, topic and app
+    '''
+    markers: List[FacetBucket]
+    types: List[FacetBucket]
+    topics: List[FacetBucket]
+    apps: List[FacetBucket]
+
+@strawberry.type
+class FacetedSearch:
+    '''
+    Search results with facet counts
+    '''
+    results: List[SearchResult]
+    facets: Facets
+
+def search_result(hit):
+    '''
+    SearchResult of an ES hit
+    '''
+    doc = hit['_source']
+    tags = []
+    for tag in doc['tags']:
+        tags.append(Tag(key=tag['name'], value=tag['value']))
+    return SearchResult(
+        txid=doc['txid'],
+        title=doc.get('title') or doc.get('page_title') or 'Title unavailable',
+        description=doc.get('description') or doc.get('page_description') or 'Description unavailable',
+        type=doc['type'] if 'type' in doc else 'Unknown',
+        tags=tags,
+        markers=doc['markers'] if 'markers' in doc else [],
+        snippets=hit_snippets(hit),
+        cursor=hit_cursor(hit),
+        canonical=doc.get('canonical'),
+        duplicates=doc.get('duplicates', []),
+    )
 
 @strawberry.type
 class Query:
@@ -35,39 +95,90 @@ class Query:
     Query
     '''
     @strawberry.field
-    def search(self, info: Info, query: str) -> List[SearchResult]:
+    async def search(
+        self,
+        info: Info,
+        query: str,
+        size: int = 10,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        highlight: bool = False,
+        markers: Optional[List[str]] = None,
+        type: Optional[str] = None,
+    ) -> List[SearchResult]:
         '''
         Search
         '''
-        print(f"Searching for {query}")
+        if metrics.sampled(log):
+            log.debug("Searching for %s", query)
         # res = search_client.search(query)
         # print pretty
+        try:
+            search_after = decode_cursor(cursor)
+        except ValueError as e:
+            # reported as a GraphQL error on the field, not an internal error
+            raise GraphQLError(str(e))
         res = []
-        for hit in search_client.search(query):
-            doc = hit['_source']
+        hits = await search_client.search(
+            query, size, offset, search_after, highlight, markers, type
+        )
+        for hit in hits:
             # print(json.dumps(hit, indent=4))
-            tags = []
-            for tag in doc['tags']:
-                tags.append(Tag(key=tag['name'], value=tag['value']))
-            res.append(SearchResult(
-                txid=doc['txid'],
-                title= doc['title'] if 'title' in doc else 'Title unavailable',
-                description=doc['description'] if 'description' in doc else 'Description unavailable',
-                type=doc['type'] if 'type' in doc else 'Unknown',
-                tags=tags,
-                markers=doc['markers'] if 'markers' in doc else []
-            ))
+            res.append(search_result(hit))
         # print(json.dumps(res, indent=4))
         return res
+
+    @strawberry.field
+    async def facets(
+        self,
+        info: Info,
+        query: str,
+        size: int = 10,
+        markers: Optional[List[str]] = None,
+        type: Optional[str] = None,
+        facet_size: int = 10,
+    ) -> FacetedSearch:
+        '''
+        Search with facet counts by markers, type, topic and app
+
+        `markers`/`type` narrow the results, the counts are for the whole query
+        '''
+        res = await search_client.facets(query, size, markers, type, facet_size)
+        facets = {
+            name: [FacetBucket(value=b['value'], count=b['count']) for b in buckets]
+            for name, buckets in res['facets'].items()
+        }
+        return FacetedSearch(
+            results=[search_result(hit) for hit in res['hits']],
+            facets=Facets(**facets),
+        )
     
     @strawberry.field
-    def get(self, info: Info, txid: str) -> Optional[SearchResult]:
+    async def get(self, info: Info, txid: str) -> Optional[SearchResult]:
         '''
         Get
         '''
-        return search_client.get(txid)
+        hit = await info.context['txid_loader'].load(txid)
+        return search_result(hit) if hit is not None else None
+
+    @strawberry.field
+    async def get_many(self, info: Info, txids: List[str]) -> List[Optional[SearchResult]]:
+        '''
+        Get several documents, in the order of txids
+        '''
+        hits = await info.context['txid_loader'].load_many(txids)
+        return [search_result(hit) if hit is not None else None for hit in hits]
     
 
+async def get_context():
+    '''
+    Per request context
+
+    The txid loader batches the `get` fields resolved together in one query into a
+    single mget, and dedups repeated txids.
+    '''
+    return {'txid_loader': DataLoader(load_fn=search_client.get_many)}
+
 schema = strawberry.Schema(query=Query)
-router = GraphQLRouter(schema=schema)
+router = GraphQLRouter(schema=schema, context_getter=get_context)
 
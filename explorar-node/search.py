@@ -6,46 +6,419 @@ import time
 import json
 from dotenv import load_dotenv
 import asyncio
-from elasticsearch import Elasticsearch
+import re
+from cache import ResultCache, cache_key, normalize_query
+from clients import get_elastic, close_elastic
+import metrics
+
+# _source fields the API returns, content is only ever shown as highlighted snippets
+RESULT_FIELDS = ["txid", "title", "description", "type", "tags", "markers",
+                 "page_title", "page_description", "canonical", "duplicates"]
+# one result per content: TXs whose body duplicates an earlier TX's are left out, their
+# titles, descriptions and topics are searchable on the canonical TX (duplicate_text)
+CANONICAL_FILTER = {"bool": {"must_not": {"exists": {"field": "canonical"}}}}
+HIGHLIGHT = {
+    "fields": {"content": {"fragment_size": 150, "number_of_fragments": 3}},
+    "pre_tags": ["<em>"],
+    "post_tags": ["</em>"],
+}
+# fields searched by text, with boosts
+SEARCH_FIELDS = ["title^4", "page_title^3", "topics^3", "description^2", "page_description^2",
+                 "duplicate_text^2", "content"]
+# tags are nested documents on the explicit mapping, searched by a separate nested query
+TAG_VALUE_BOOST = 1
+# keyword fields: the names to try on the live mapping, the explicit mapping's first,
+# then the .keyword subfields of the dynamic mapping search-artx had before it
+KEYWORD_FIELDS = {
+    "txid": ["txid", "txid.keyword"],
+    "markers": ["markers", "markers.keyword"],
+    "type": ["type", "type.keyword"],
+    "app_name": ["app_name", "app_name.keyword"],
+    "topics": ["topics.raw", "topics.keyword"],
+}
+# field names on the explicit mapping
+DEFAULT_FIELDS = dict({name: names[0] for name, names in KEYWORD_FIELDS.items()}, nested_tags=True)
+# Lucene syntax characters: wildcards, regexes, fuzziness, ranges, fields and grouping
+QUERY_SYNTAX = re.compile(r'[*?~/\\\[\]{}()^"<>:!&|+=]')
+MAX_QUERY_LENGTH = 256
+MAX_QUERY_TERMS = 32
+MAX_SIZE = 100
+# term aggregations over keyword fields (keys of KEYWORD_FIELDS), by facet name
+FACETS = {
+    "markers": "markers",
+    "types": "type",
+    "topics": "topics",
+    "apps": "app_name",
+}
+MAX_FACET_SIZE = 50
+# ES refuses from + size beyond index.max_result_window
+MAX_RESULT_WINDOW = 10000
+
+search_client = None
+
+SEARCH_SECONDS = metrics.histogram("es_search_seconds", "ES request latency of searches, by operation")
+
+
+def sanitize_query(query):
+    """
+    Reduce user input to plain search terms
+
+    Strips the characters that make up wildcard, regex, fuzzy and other Lucene
+    syntax, so no query can expand into an expensive term scan, and caps its size.
+    """
+    terms = QUERY_SYNTAX.sub(" ", query[:MAX_QUERY_LENGTH]).split()
+    # a leading "-" would otherwise read as negation in some parsers
+    terms = [term.strip("-") for term in terms]
+    return " ".join(term for term in terms[:MAX_QUERY_TERMS] if term)
+
+
+def field_type(properties, path):
+    """
+    Type of a field or multi-field ("txid.keyword") in mapping properties, or None
+    """
+    (name, _, subfield) = path.partition(".")
+    field = properties.get(name, {})
+    if subfield:
+        field = field.get("fields", {}).get(subfield, {})
+    return field.get("type")
+
+
+def mapping_fields(mappings):
+    """
+    Field names to query by, from the get_mapping response for INDEX_ALIAS
+
+    Picks, per KEYWORD_FIELDS entry, the first name that is a keyword field in every
+    index behind the alias, so searches keep working on an index that still has the
+    dynamic mapping, before and during `indexer.py --migrate`.
+    """
+    indices = [index["mappings"].get("properties", {}) for index in mappings.values()]
+    fields = {}
+    for name, names in KEYWORD_FIELDS.items():
+        fields[name] = next(
+            (path for path in names
+             if all(field_type(properties, path) == "keyword" for properties in indices)),
+            names[0],
+        )
+    fields["nested_tags"] = len(indices) > 0 and all(
+        properties.get("tags", {}).get("type") == "nested" for properties in indices
+    )
+    return fields
+
+
+def result_sort(fields=DEFAULT_FIELDS):
+    """
+    Stable order for search_after: score, then txid as the tie breaker
+    """
+    # unmapped_type: a mapping that changed since it was read sorts, rather than fails
+    return ["_score", {fields["txid"]: {"order": "asc", "unmapped_type": "keyword"}}]
+
+
+def build_filters(markers=None, type=None, fields=DEFAULT_FIELDS):
+    """
+    Filter clauses for results with any of `markers` and/or of `type`
+    """
+    filters = []
+    if markers:
+        filters.append({"terms": {fields["markers"]: list(markers)}})
+    if type:
+        filters.append({"term": {fields["type"]: type}})
+    return filters
+
+
+def build_query(query, markers=None, type=None, fields=DEFAULT_FIELDS):
+    """
+    Build the relevance query for user input
+
+    Terms are matched with multi_match over SEARCH_FIELDS, exact phrases in the
+    title score higher, and markers/type narrow the results as filters (which
+    don't affect scoring and are cached by ES). `fields` are the field names of
+    the live mapping, see mapping_fields().
+    """
+    text = sanitize_query(query)
+    filters = [CANONICAL_FILTER] + build_filters(markers, type, fields)
+    tag_match = {
+        "match": {
+            "tags.value": {
+                "query": text,
+                "minimum_should_match": "2<75%",
+                "boost": TAG_VALUE_BOOST,
+            }
+        }
+    }
+    if fields["nested_tags"]:
+        tag_match = {"nested": {"path": "tags", "query": tag_match, "score_mode": "max"}}
+    if not text:
+        return {"bool": {"must": [{"match_all": {}}], "filter": filters}}
+    return {
+        "bool": {
+            "must": [
+                {
+                    "bool": {
+                        "should": [
+                            {
+                                "multi_match": {
+                                    "query": text,
+                                    "fields": SEARCH_FIELDS,
+                                    "type": "best_fields",
+                                    "tie_breaker": 0.3,
+                                    "minimum_should_match": "2<75%",
+                                }
+                            },
+                            tag_match,
+                        ]
+                    }
+                }
+            ],
+            "should": [
+                {"match_phrase": {"title": {"query": text, "boost": 2}}},
+                {"match_phrase": {"page_title": {"query": text, "boost": 1.5}}},
+            ],
+            "filter": filters,
+        }
+    }
+
+
+def hit_cursor(hit):
+    """
+    Opaque cursor of a hit, pass it back as search_after for the next page
+    """
+    return json.dumps(hit["sort"]) if "sort" in hit else None
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from hit_cursor()
+
+    Raises ValueError unless it's the [score, txid] sort values of result_sort()
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(cursor)
+    except ValueError:
+        raise ValueError("Invalid cursor: not JSON")
+    if (not isinstance(values, list) or len(values) != len(result_sort())
+            or isinstance(values[0], bool) or not isinstance(values[0], (int, float))
+            or not isinstance(values[1], str)):
+        raise ValueError("Invalid cursor: expected the cursor of a search result")
+    return values
+
+
+def hit_snippets(hit):
+    """
+    Highlighted content snippets of a hit
+    """
+    return hit.get("highlight", {}).get("content", [])
+
+
+def facet_buckets(aggregations):
+    """
+    {facet: [{"value", "count"}]} from the term aggregations of a facets search
+    """
+    return {
+        name: [{"value": b["key"], "count": b["doc_count"]} for b in aggregations[name]["buckets"]]
+        for name in FACETS
+    }
+
 
 class SearchClient:
     """
     Search client class
+
+    Async, on the pooled AsyncElasticsearch client of clients.py, so searches don't
+    block the event loop of the API server. Constructing it does no network I/O.
     """
 
-    def __init__(self):
+    def __init__(self, client=None):
         """
         Constructor
         """
         load_dotenv()
-        self.client = Elasticsearch(
-            "http://" + os.getenv("ELASTICSEARCH_HOST") + ":" + os.getenv("ELASTICSEARCH_PORT"),
-            api_key=os.getenv("ELASTICSEARCH_API_KEY"),
+        self.client = client or get_elastic()
+        self.cache = ResultCache()
+        # facet counts change slowly and cost more to compute, keep them longer
+        self.facet_cache = ResultCache(ttl=os.getenv("SEARCH_FACET_CACHE_TTL", "300"))
+        # popular documents for point lookups, in process only: a Redis round trip
+        # costs about as much as the mget it would save
+        self.document_cache = ResultCache(
+            max_bytes=os.getenv("SEARCH_DOCUMENT_CACHE_BYTES", str(32 * 1024 * 1024)),
+            ttl=os.getenv("SEARCH_DOCUMENT_CACHE_TTL", "300"),
+            share=False,
         )
-        # API key should have cluster monitor rights
-        self.client.info()
-        print("Initialized ES client: Elasticsearch version:", self.client.info()["version"]["number"])
+        # field names of the live mapping, re-read every fields_seconds
+        self.field_names = DEFAULT_FIELDS
+        self.fields_checked = None
+        self.fields_seconds = float(os.getenv("SEARCH_MAPPING_CHECK_SECONDS", "60"))
 
-    def search(self, query):
+    async def fields(self):
+        """
+        Field names to query by on the live mapping of search-artx, see mapping_fields()
+        """
+        now = time.monotonic()
+        if self.fields_checked is None or now - self.fields_checked >= self.fields_seconds:
+            try:
+                self.field_names = mapping_fields(
+                    await self.client.indices.get_mapping(index="search-artx")
+                )
+            except Exception as e:
+                print("Search: Could not read the index mapping:", repr(e))
+            self.fields_checked = now
+        return self.field_names
+
+    async def info(self):
+        """
+        Check the connection, the API key should have cluster monitor rights
+        """
+        info = await self.client.info()
+        print("Initialized ES client: Elasticsearch version:", info["version"]["number"])
+        return info
+
+    async def close(self):
+        """
+        Close the client connection pool
+        """
+        await close_elastic()
+
+    async def search(self, query, size=10, offset=0, search_after=None, highlight=False,
+                     markers=None, type=None):
         """
         Search
+
+        Returns up to `size` hits, skipping `offset`, or those after the `search_after`
+        sort values of the last hit of the previous page. Hits only carry
+        RESULT_FIELDS, plus content snippets if `highlight` is set. `markers` and
+        `type` restrict the hits to documents with any of the markers / that type.
         """
+        size = max(0, min(int(size), MAX_SIZE))
+        offset = max(0, min(int(offset), MAX_RESULT_WINDOW - size))
+        markers = sorted(markers) if markers else None
+        key = cache_key("search", normalize_query(query), size, offset, search_after,
+                        highlight, markers, type)
+        hits = await self.cache.get(key)
+        if hits is not None:
+            return hits
+        fields = await self.fields()
+        body = {
+            "query": build_query(query, markers, type, fields),
+            "size": size,
+            "_source": {"includes": RESULT_FIELDS},
+            "sort": result_sort(fields),
+        }
+        if search_after is not None:
+            body["search_after"] = search_after
+        else:
+            body["from"] = offset
+        if highlight:
+            body["highlight"] = HIGHLIGHT
         # search
-        res = self.client.search(
-            index="search-artx",
-            q=query,
-        )
+        with SEARCH_SECONDS.time(op="search"):
+            res = await self.client.search(
+                index="search-artx",
+                body=body,
+            )
+        hits = res["hits"]["hits"]
+        await self.cache.set(key, hits)
         # return the results
-        return res["hits"]["hits"]
-    
+        return hits
+
+    async def get_many(self, txids):
+        """
+        Get documents by txid
+
+        Returns a list with the hit (with RESULT_FIELDS as _source) of each txid, or
+        None where there is no such document. Cached documents are served from the
+        document cache, the rest are fetched with one mget.
+        """
+        txids = list(txids)
+        docs = {}
+        missing = []
+        for txid in set(txids):
+            doc = await self.document_cache.get(cache_key("doc", txid))
+            if doc is not None:
+                docs[txid] = doc
+            else:
+                missing.append(txid)
+        for i in range(0, len(missing), MAX_SIZE):
+            with SEARCH_SECONDS.time(op="mget"):
+                res = await self.client.mget(
+                    index="search-artx",
+                    ids=missing[i : i + MAX_SIZE],
+                    _source_includes=RESULT_FIELDS,
+                )
+            for doc in res["docs"]:
+                if doc.get("found"):
+                    doc = {"_id": doc["_id"], "_source": doc["_source"]}
+                    docs[doc["_id"]] = doc
+                    await self.document_cache.set(cache_key("doc", doc["_id"]), doc)
+        return [docs.get(txid) for txid in txids]
+
+    async def get(self, txid):
+        """
+        Get a document by txid, or None
+        """
+        return (await self.get_many([txid]))[0]
+
+    async def facets(self, query, size=10, markers=None, type=None, facet_size=10):
+        """
+        Search with facet counts
+
+        Returns {"hits": [...], "facets": {facet: [{"value", "count"}]}} from a single
+        request. Counts are for the whole text query; `markers` and `type` only narrow
+        the hits (as a post_filter), so the counts of the other choices stay visible.
+        """
+        size = max(0, min(int(size), MAX_SIZE))
+        facet_size = max(1, min(int(facet_size), MAX_FACET_SIZE))
+        markers = sorted(markers) if markers else None
+        key = cache_key("facets", normalize_query(query), size, markers, type, facet_size)
+        result = await self.facet_cache.get(key)
+        if result is not None:
+            return result
+        fields = await self.fields()
+        body = {
+            "query": build_query(query, fields=fields),
+            "size": size,
+            "_source": {"includes": RESULT_FIELDS},
+            "sort": result_sort(fields),
+            "aggs": {name: {"terms": {"field": fields[field], "size": facet_size}}
+                     for name, field in FACETS.items()},
+        }
+        filters = build_filters(markers, type, fields)
+        if filters:
+            body["post_filter"] = {"bool": {"filter": filters}}
+        with SEARCH_SECONDS.time(op="facets"):
+            res = await self.client.search(
+                index="search-artx",
+                body=body,
+            )
+        result = {"hits": res["hits"]["hits"], "facets": facet_buckets(res["aggregations"])}
+        await self.facet_cache.set(key, result)
+        return result
+
+def get_search_client():
+    """
+    Shared SearchClient of the process, so its caches are shared too
+    """
+    global search_client
+    if search_client is None:
+        search_client = SearchClient()
+    return search_client
+
+
+async def main(query):
+    search_client = SearchClient()
+    try:
+        await search_client.info()
+        return await search_client.search(query)
+    finally:
+        await search_client.close()
+
 if __name__ == "__main__":
     load_dotenv()
-    search_client = SearchClient()
     # search
     if len(sys.argv) > 1:
         query = sys.argv[1]
     else:
         query = "redstone"
-    res = search_client.search(query)
+    res = asyncio.run(main(query))
     # print the results
     print(json.dumps(res, indent=4))
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the services are top-level modules of explorar-node
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,128 @@
+"""
+fakes.py
+
+In-memory stand-ins for the Elasticsearch client, the frontier and the Arweave client,
+recording the calls the crawler and the indexer make.
+"""
+
+import asyncio
+
+
+class FakeIndices:
+
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.mappings = []
+
+    async def get_alias(self, name):
+        return self.aliases
+
+    async def exists(self, index):
+        return True
+
+    async def put_mapping(self, index, **mappings):
+        self.mappings.append(index)
+
+
+class FakeElastic:
+    """
+    AsyncElasticsearch stand-in: bulk() answers each item with the next status from
+    `statuses` (201 once they run out) and keeps the operations it was sent. With a
+    `gate` event, bulk requests wait for it to be set, then take `delay` seconds
+    """
+
+    def __init__(self, statuses=(), aliases=None, gate=None, delay=0):
+        self.statuses = list(statuses)
+        self.gate = gate
+        self.delay = delay
+        self.bulks = []
+        self.indices = FakeIndices(aliases or {})
+        self.closed = False
+
+    async def bulk(self, operations):
+        self.bulks.append(operations)
+        if self.gate is not None:
+            await self.gate.wait()
+        await asyncio.sleep(self.delay)
+        items = []
+        for action in operations[::2]:
+            (op, meta), = action.items()
+            status = self.statuses.pop(0) if self.statuses else 201
+            result = {"_id": meta["_id"], "status": status}
+            if status == 429:
+                result["error"] = {"type": "es_rejected_execution_exception"}
+            elif status >= 300:
+                result["error"] = {"type": "mapper_parsing_exception"}
+            items.append({op: result})
+        errors = any(next(iter(item.values()))["status"] >= 300 for item in items)
+        return {"errors": errors, "items": items}
+
+    def bulk_ids(self, n):
+        return [action[next(iter(action))]["_id"] for action in self.bulks[n][::2]]
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeFrontier:
+    """
+    AsyncFrontier stand-in: claim_txs() hands out the batches in `claims`, then nothing
+    """
+
+    lease_seconds = 60
+
+    def __init__(self, claims):
+        self.claims = list(claims)
+        self.crawled = []
+        self.released = []
+        self.closed = False
+
+    async def test_db(self):
+        pass
+
+    async def init_indexes(self):
+        pass
+
+    async def claim_txs(self, k, block_no=None):
+        return self.claims.pop(0) if self.claims else []
+
+    async def claim_content_hash(self, hash, txid):
+        return txid
+
+    async def release_content_hash(self, hash, txid):
+        pass
+
+    async def mark_tx_crawled(self, tx):
+        self.crawled.append(tx["txid"])
+
+    async def renew_leases(self, txs):
+        pass
+
+    async def reclaim_expired_leases(self):
+        pass
+
+    async def release_leases(self, txs):
+        self.released.extend(tx["txid"] for tx in txs)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeArweave:
+    """
+    ArweaveClient stand-in whose batched tag lookups never return, so the TXs that
+    need them stay in flight
+    """
+
+    def __init__(self):
+        self.looking_up = asyncio.Event()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def get_txs_tags(self, txids):
+        self.looking_up.set()
+        await asyncio.Future()
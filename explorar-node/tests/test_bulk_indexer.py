@@ -0,0 +1,147 @@
+import asyncio
+
+from redis.exceptions import RedisError
+
+import cache
+import indexer
+from indexer import BulkIndexer
+from fakes import FakeElastic
+
+
+def no_backoff(monkeypatch):
+    sleep = asyncio.sleep
+    monkeypatch.setattr(indexer.asyncio, "sleep", lambda seconds: sleep(0))
+
+
+def test_bulk_retries_rejected_items(monkeypatch):
+    no_backoff(monkeypatch)
+
+    async def run():
+        # "b" is rejected with 429 once, then accepted
+        client = FakeElastic(statuses=[201, 429, 201, 201])
+        bulk = BulkIndexer(client, "test", max_docs=100, max_retries=3)
+        a = await bulk.index({"txid": "a"}, "a")
+        b = await bulk.index({"txid": "b"}, "b")
+        c = await bulk.index({"txid": "c"}, "c")
+        await bulk.close()
+        return client, bulk, [a.result(), b.result(), c.result()]
+
+    client, bulk, results = asyncio.run(run())
+    assert results == [True, True, True]
+    assert client.bulk_ids(0) == ["a", "b", "c"]
+    # only the rejected item is sent again
+    assert client.bulk_ids(1) == ["b"]
+    assert bulk.stats == {"bulks": 2, "indexed": 3, "retried": 1, "failed": 0}
+
+
+def test_bulk_gives_up_after_max_retries(monkeypatch):
+    no_backoff(monkeypatch)
+
+    async def run():
+        client = FakeElastic(statuses=[429, 400, 429, 429])
+        bulk = BulkIndexer(client, "test", max_docs=100, max_retries=2)
+        rejected = await bulk.index({"txid": "a"}, "a")
+        invalid = await bulk.update({"title": "b"}, "b")
+        await bulk.close()
+        return client, bulk, [rejected.result(), invalid.result()]
+
+    client, bulk, results = asyncio.run(run())
+    # the 429 is retried max_retries times and left unwritten, the mapping error is final
+    assert results == [None, False]
+    assert client.bulks[0][2]["update"]["retry_on_conflict"] == 3
+    assert [client.bulk_ids(n) for n in range(len(client.bulks))] == [["a", "b"], ["a"], ["a"]]
+    assert bulk.stats["failed"] == 2
+
+
+def test_bulk_flushes_full_buffer():
+    async def run():
+        client = FakeElastic()
+        bulk = BulkIndexer(client, "test", max_docs=2, flush_seconds=60)
+        await bulk.index({"txid": "a"}, "a")
+        await bulk.index({"txid": "b"}, "b")
+        await bulk.index({"txid": "c"}, "c")
+        # "c" waits for the timer or close()
+        await asyncio.gather(*bulk.sending)
+        sent = [client.bulk_ids(n) for n in range(len(client.bulks))]
+        await bulk.close()
+        return client, sent
+
+    client, sent = asyncio.run(run())
+    assert sent == [["a", "b"]]
+    assert client.bulk_ids(1) == ["c"]
+
+
+class FailingRedis:
+
+    async def incr(self, key):
+        raise RedisError("down")
+
+
+def test_bulk_survives_redis_outage(monkeypatch):
+    """
+    A failed cache invalidation neither fails written items nor stops retries
+    """
+    no_backoff(monkeypatch)
+    monkeypatch.setattr(cache, "get_async_redis", FailingRedis)
+    monkeypatch.setattr(cache, "last_bump", 0.0)
+    monkeypatch.setenv("INDEX_VERSION_BUMP_SECONDS", "0")
+
+    async def run():
+        client = FakeElastic(statuses=[201, 429, 201])
+        bulk = BulkIndexer(client, "test", max_docs=100, max_retries=3,
+                           on_written=cache.bump_index_version)
+        a = await bulk.index({"txid": "a"}, "a")
+        b = await bulk.index({"txid": "b"}, "b")
+        await bulk.close()
+        return bulk, [a.result(), b.result()]
+
+    bulk, results = asyncio.run(run())
+    assert results == [True, True]
+    assert bulk.stats == {"bulks": 2, "indexed": 2, "retried": 1, "failed": 0}
+
+
+def test_bulk_close_waits_for_queued_flushes():
+    """
+    close() waits for a flush that is queued behind a full pipeline, e.g. the timer's
+    """
+
+    async def run():
+        gate = asyncio.Event()
+        client = FakeElastic(gate=gate, delay=0.05)
+        bulk = BulkIndexer(client, "test", max_docs=100, flush_seconds=0.01, max_in_flight=1)
+        a = await bulk.index({"txid": "a"}, "a")
+        await bulk.flush()
+        # "a" holds the only slot, the timer flushes "b" and waits for it
+        b = await bulk.index({"txid": "b"}, "b")
+        await asyncio.sleep(0.05)
+        assert bulk.buffer == [] and not b.done()
+        closing = asyncio.create_task(bulk.close())
+        await asyncio.sleep(0.05)
+        assert not closing.done()
+        gate.set()
+        await closing
+        assert b.done() and bulk.sending == set()
+        return client, [a.result(), b.result()]
+
+    client, results = asyncio.run(run())
+    assert results == [True, True]
+    assert [client.bulk_ids(n) for n in range(len(client.bulks))] == [["a"], ["b"]]
+
+
+def test_bulk_full_pipeline_pushes_back():
+    async def run():
+        gate = asyncio.Event()
+        client = FakeElastic(gate=gate)
+        bulk = BulkIndexer(client, "test", max_docs=1, max_in_flight=2)
+        await bulk.index({"txid": "a"}, "a")
+        await bulk.index({"txid": "b"}, "b")
+        # a third request has to wait for one of the two outstanding ones
+        third = asyncio.create_task(bulk.index({"txid": "c"}, "c"))
+        await asyncio.sleep(0.05)
+        blocked = not third.done()
+        gate.set()
+        await third
+        await bulk.close()
+        return blocked, bulk.stats["indexed"]
+
+    assert asyncio.run(run()) == (True, 3)
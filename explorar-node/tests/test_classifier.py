@@ -0,0 +1,76 @@
+from classifier import classify_tags, classify_batch, classify, ENRICHMENT_VERSION
+
+
+def tags(*pairs):
+    return [{"name": name, "value": value} for name, value in pairs]
+
+
+ANS_110 = tags(("Title", "Title"), ("Type", "page"), ("Description", "Description"),
+               ("Topic:art", "art"), ("Topic:music", "music"),
+               ("Content-Type", "text/html; charset=utf-8"))
+
+
+def test_ans110():
+    assert classify_tags(ANS_110) == {
+        "title": "Title",
+        "type": "page",
+        "description": "Description",
+        "topics": ["art", "music"],
+        "markers": ["HTML", "ANS-110"],
+    }
+
+
+def test_ans110_without_topics():
+    fields = classify_tags(tags(("Title", "Title"), ("Type", "page")))
+    # the list field of a satisfied rule defaults to empty
+    assert fields == {"title": "Title", "type": "page", "topics": [], "markers": ["ANS-110"]}
+
+
+def test_nft():
+    fields = classify_tags(tags(("Content-Type", "image/png"), ("Title", "Title"), ("Type", "image")))
+    assert fields["markers"] == ["Image", "ANS-110", "NFT"]
+
+
+def test_nft_content_type_spelling():
+    # some uploaders tag ContentType, which only counts towards NFT
+    fields = classify_tags(tags(("ContentType", "image/png"), ("Title", "Title"), ("Type", "image")))
+    assert fields["markers"] == ["ANS-110", "NFT"]
+
+
+def test_udl():
+    fields = classify_tags(tags(("Title", "Title"), ("Type", "music"), ("License", "udl://license")))
+    assert fields["markers"] == ["ANS-110", "UDL"]
+
+
+def test_missing_title_or_type():
+    # without both, the ANS-110 rules and the markers gated on it don't apply
+    for missing in ("Title", "Type"):
+        fields = classify_tags([tag for tag in
+                                tags(("Title", "Title"), ("Type", "page"), ("Description", "D"),
+                                     ("Topic:a", "a"), ("Content-Type", "image/png"),
+                                     ("License", "udl://license"))
+                                if tag["name"] != missing])
+        assert fields == {"markers": ["Image"]}
+
+
+def test_non_ans_document():
+    fields = classify_tags(tags(("Content-Type", "application/json"), ("App-Name", "ArDrive"),
+                                ("Bundle-Format", "binary")))
+    assert fields == {"app_name": "ArDrive", "markers": ["JSON", "App:ArDrive", "ANS-104"]}
+
+
+def test_no_markers():
+    assert classify_tags([]) == {"markers": None}
+    assert classify_tags(tags(("X-Custom", "value"))) == {"markers": None}
+
+
+def test_classify_batch():
+    lists = [ANS_110, [], tags(("Content-Type", "video/mp4"))]
+    assert classify_batch(lists) == [classify_tags(t) for t in lists]
+
+
+def test_classify():
+    doc = classify({"txid": "a", "tags": tags(("Content-Type", "image/png"))})
+    # None fields are left out of the document
+    assert doc == {"txid": "a", "tags": tags(("Content-Type", "image/png")),
+                   "markers": ["Image"], "enrichment_version": ENRICHMENT_VERSION}
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+import cache
+import clients
+import crawler
+from crawler import Crawler, Stage
+from indexer import INDEX_ALIAS, versioned_index_name
+from fakes import FakeElastic, FakeFrontier, FakeArweave
+
+
+async def wait_until(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_stage_pipeline():
+    """
+    Results go to the next stage, None drops a job, errors are reported and drop it
+    """
+    out = []
+    errors = []
+
+    async def double(job):
+        await asyncio.sleep(0)
+        return job * 2
+
+    async def drop_odd(job):
+        return job if job % 4 == 0 else None
+
+    async def fail_on_twenty(job):
+        if job == 20:
+            raise ValueError(job)
+        return job + 1
+
+    async def collect(job):
+        out.append(job)
+
+    async def run():
+        stages = [Stage("double", double, 3, 2), Stage("even", drop_odd, 2, 2),
+                  Stage("fail", fail_on_twenty, 1, 2), Stage("sink", collect, 1, 2)]
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        workers = [
+            asyncio.create_task(stage.work(lambda name, job, e: errors.append((name, job, e))))
+            for stage in stages
+            for _ in range(stage.workers)
+        ]
+        for job in range(12):
+            await stages[0].queue.put(job)
+        await wait_until(lambda: len(out) + len(errors) == 6)
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return stages
+
+    stages = asyncio.run(run())
+    # 0..11 doubled, those not divisible by 4 dropped, 20 failed, the rest + 1
+    assert sorted(out) == [1, 5, 9, 13, 17]
+    assert [(name, job, type(e)) for name, job, e in errors] == [("fail", 20, ValueError)]
+    assert [stage.processed for stage in stages] == [12, 12, 6, 5]
+    assert [stage.errors for stage in stages] == [0, 0, 1, 0]
+    stats = stages[0].stats()
+    assert (stats["queued"], stats["queue_size"], stats["workers"]) == (0, 2, 3)
+
+
+def test_stage_full_queue_blocks_upstream():
+    async def identity(job):
+        return job
+
+    async def run():
+        first = Stage("first", identity, 1, 10)
+        # nothing takes jobs off the second stage's queue
+        first.next = Stage("second", identity, 1, 1)
+        worker = asyncio.create_task(first.work(None))
+        for job in range(3):
+            await first.queue.put(job)
+        await asyncio.sleep(0.05)
+        depths = (first.queue.qsize(), first.next.queue.qsize(), first.processed)
+        worker.cancel()
+        return depths
+
+    # one job queued downstream, one held by the blocked worker, one left upstream
+    assert asyncio.run(run()) == (1, 1, 2)
+
+
+def tx(txid, tags):
+    return {"txid": txid, "tags": tags}
+
+
+def test_crawl_lifecycle_shutdown(monkeypatch):
+    """
+    Cancelling the crawl flushes buffered documents, marks them crawled, releases the
+    leases of unfinished TXs and closes the clients
+    """
+    monkeypatch.setenv("CRAWLER_PARSE_WORKERS", "1")
+    monkeypatch.setenv("CRAWLER_METRICS_PORT", "0")
+    # documents stay buffered until shutdown
+    monkeypatch.setenv("INDEXER_FLUSH_SECONDS", "60")
+    monkeypatch.setattr(cache, "get_async_redis", lambda: None)
+    es = FakeElastic(aliases={versioned_index_name(): {"aliases": {INDEX_ALIAS: {}}}})
+    monkeypatch.setattr(clients, "elastic", es)
+    # "a" has its tags, "b" waits for a tag lookup that never returns
+    frontier = FakeFrontier([[tx("a", [{"name": "Content-Type", "value": "image/png"}])],
+                             [tx("b", None)]])
+    monkeypatch.setattr(crawler, "AsyncFrontier", lambda: frontier)
+    arweave = FakeArweave()
+    monkeypatch.setattr(crawler, "ArweaveClient", lambda: arweave)
+
+    async def run():
+        crawl = Crawler(concurrency=2)
+        task = asyncio.create_task(crawl.crawl_lifecycle())
+        await wait_until(lambda: len(crawl.indexer.bulk.buffer) == 1 and arweave.looking_up.is_set())
+        assert es.bulks == [] and frontier.crawled == []
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert es.indices.mappings == [versioned_index_name()]
+    assert es.bulk_ids(0) == ["a"]
+    assert frontier.crawled == ["a"]
+    assert frontier.released == ["b"]
+    assert es.closed and frontier.closed
@@ -0,0 +1,33 @@
+import asyncio
+
+import cache
+import clients
+from indexer import AsyncIndexer, DUPLICATE_FIELDS
+from fakes import FakeElastic
+
+
+def test_canonical_reindex_keeps_duplicates(monkeypatch):
+    """
+    Documents that may be canonical are written with a scripted upsert that keeps the
+    duplicate fields, the others with a plain index
+    """
+    monkeypatch.setattr(cache, "get_async_redis", lambda: None)
+    es = FakeElastic()
+    monkeypatch.setattr(clients, "elastic", es)
+
+    async def run():
+        indexer = AsyncIndexer()
+        canonical = {"txid": "a", "content_hash": "h", "content": "text"}
+        duplicate = {"txid": "b", "content_hash": "h", "canonical": "a"}
+        plain = {"txid": "c"}
+        written = [await indexer.index_document(doc) for doc in (canonical, duplicate, plain)]
+        await indexer.close()
+        return [future.result() for future in written]
+
+    assert asyncio.run(run()) == [True, True, True]
+    ops = es.bulks[0]
+    assert [next(iter(action)) for action in ops[::2]] == ["update", "index", "index"]
+    upsert = ops[1]
+    assert upsert["upsert"] == {"txid": "a", "content_hash": "h", "content": "text"}
+    assert upsert["script"]["params"]["kept"] == DUPLICATE_FIELDS
+    assert es.closed
@@ -0,0 +1,16 @@
+import pytest
+
+from search import hit_cursor, decode_cursor
+
+
+def test_cursor_round_trip():
+    hit = {"_id": "a", "sort": [1.5, "a"]}
+    assert decode_cursor(hit_cursor(hit)) == [1.5, "a"]
+    assert decode_cursor(None) is None and decode_cursor("") is None
+
+
+@pytest.mark.parametrize("cursor", ["not json", "{}", '"a"', "[1.5]", '[1.5, "a", 2]',
+                                    '["a", "b"]', '[true, "a"]', "[1.5, 2]"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)